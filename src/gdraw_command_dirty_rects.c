@@ -0,0 +1,56 @@
+/*
+ * Copyright (c) 2015 Pebble Technology
+ */
+
+#include <pebble.h>
+#include "gdraw_command_dirty_rects.h"
+
+struct __attribute__((__packed__)) GDrawCommandDirtyRects {
+  char magic[4];
+  uint32_t size;
+  uint16_t num_frames;
+  GRect rects[];
+};
+
+GDrawCommandDirtyRects *gdraw_command_dirty_rects_create_with_resource(uint32_t resource_id) {
+  ResHandle handle = resource_get_handle(resource_id);
+  size_t size = resource_size(handle);
+  if (size < sizeof(GDrawCommandDirtyRects)) {
+    return NULL;
+  }
+
+  GDrawCommandDirtyRects *dirty_rects = malloc(size);
+  if (!dirty_rects) {
+    return NULL;
+  }
+  resource_load(handle, (uint8_t *) dirty_rects, size);
+  if (memcmp(dirty_rects->magic, "PDCD", 4) != 0 ||
+      size < sizeof(GDrawCommandDirtyRects) + dirty_rects->num_frames * sizeof(GRect)) {
+    free(dirty_rects);
+    return NULL;
+  }
+  return dirty_rects;
+}
+
+void gdraw_command_dirty_rects_destroy(GDrawCommandDirtyRects *dirty_rects) {
+  free(dirty_rects);
+}
+
+uint16_t gdraw_command_dirty_rects_get_num_frames(GDrawCommandDirtyRects *dirty_rects) {
+  return dirty_rects ? dirty_rects->num_frames : 0;
+}
+
+GRect gdraw_command_dirty_rects_get_rect(GDrawCommandDirtyRects *dirty_rects, uint32_t frame_index) {
+  if (!dirty_rects || frame_index >= dirty_rects->num_frames) {
+    return GRectZero;
+  }
+  return dirty_rects->rects[frame_index];
+}
+
+bool gdraw_command_dirty_rects_frame_changed(GDrawCommandDirtyRects *dirty_rects, uint32_t frame_index) {
+  if (!dirty_rects || frame_index >= dirty_rects->num_frames) {
+    return true; // nothing is known about the frame, assume it changes
+  }
+  const GRect rect = dirty_rects->rects[frame_index];
+  return rect.size.w > 0 && rect.size.h > 0;
+}
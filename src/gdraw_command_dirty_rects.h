@@ -0,0 +1,22 @@
+/*
+ * Copyright (c) 2015 Pebble Technology
+ */
+
+#pragma once
+
+#include <pebble.h>
+
+// Region that changes in every frame of a GDrawCommandSequence, as written by tools/svg2pdc.py --dirty-rects
+// The rect of the first frame is the change from the last frame, so the whole layer has to be drawn before
+// the sequence starts playing
+typedef struct GDrawCommandDirtyRects GDrawCommandDirtyRects;
+
+GDrawCommandDirtyRects *gdraw_command_dirty_rects_create_with_resource(uint32_t resource_id);
+void gdraw_command_dirty_rects_destroy(GDrawCommandDirtyRects *dirty_rects);
+uint16_t gdraw_command_dirty_rects_get_num_frames(GDrawCommandDirtyRects *dirty_rects);
+GRect gdraw_command_dirty_rects_get_rect(GDrawCommandDirtyRects *dirty_rects, uint32_t frame_index);
+
+// Whether the frame changes anything on screen. Frames that don't (e.g. the same image shown longer) don't need
+// layer_mark_dirty() at all. Otherwise gdraw_command_dirty_rects_get_rect() gives the region to redraw, relative to
+// where the sequence is drawn.
+bool gdraw_command_dirty_rects_frame_changed(GDrawCommandDirtyRects *dirty_rects, uint32_t frame_index);
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Pebble Technology
+#
+'''
+PDC_DECODER reads PDC (Pebble Draw Command) images and sequences, as written by svg2pdc.py, back. Files are memory
+mapped and frames and commands are decoded lazily, straight from the mapping, so large sequences can be inspected
+without copying them.
+
+The sequence format (following the 'PDCS' file header described in svg2pdc.py) is:
+| 1     | Version
+| 1     | Reserved
+| 2     | Width
+| 2     | Height
+| 2     | Play count
+| 2     | Number of frames
+Followed by the frames:
+| 2     | Duration
+| 2     | Number of commands
+Followed by the commands (see svg2pdc.Command)
+
+Images ('PDCI') have the same header without the play count and number of frames, followed by a single command list.
+'''
+
+import argparse
+import mmap
+import os
+import sys
+from array import array
+from struct import unpack_from
+
+import svg2pdc
+from svg2pdc import FILE_HEADER, IMAGE_HEADER, SEQUENCE_HEADER, FRAME_HEADER, COMMAND_LIST_HEADER, PATH_HEADER, \
+    CIRCLE_HEADER, POINT, DRAW_COMMAND_TYPE_CIRCLE, DRAW_COMMAND_TYPE_PATH, DRAW_COMMAND_TYPE_PRECISE_PATH
+
+
+class PDCFormatError(Exception):
+    pass
+
+
+class DecodedCommand(object):
+    '''
+    A draw command decoded in place. The header fields are unpacked when the command is created, the points are only
+    unpacked when they're asked for.
+    '''
+    __slots__ = ('buf', 'offset', 'type', 'header', 'stroke_color', 'stroke_width', 'fill_color', 'open', 'radius',
+                 'num_points')
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+        if offset + PATH_HEADER.size > len(buf):
+            raise PDCFormatError("Command at offset {} exceeds the file".format(offset))
+        self.type = ord(buf[offset])
+        if self.type == DRAW_COMMAND_TYPE_CIRCLE:
+            self.header = CIRCLE_HEADER
+            (_, _, self.stroke_color, self.stroke_width, self.fill_color, self.radius,
+             self.num_points) = CIRCLE_HEADER.unpack_from(buf, offset)
+            self.open = None
+        elif self.type in (DRAW_COMMAND_TYPE_PATH, DRAW_COMMAND_TYPE_PRECISE_PATH):
+            self.header = PATH_HEADER
+            (_, _, self.stroke_color, self.stroke_width, self.fill_color, path_open, _,
+             self.num_points) = PATH_HEADER.unpack_from(buf, offset)
+            self.open = bool(path_open)
+            self.radius = None
+        else:
+            raise PDCFormatError("Unknown command type {} at offset {}".format(self.type, offset))
+        if self.offset + self.size > len(buf):
+            raise PDCFormatError("Points of command at offset {} exceed the file".format(offset))
+
+    @property
+    def size(self):
+        return self.header.size + self.num_points * POINT.size
+
+    @property
+    def raw_points(self):
+        # a zero-copy view of the serialized x/y pairs
+        return buffer(self.buf, self.offset + self.header.size, self.num_points * POINT.size)
+
+    @property
+    def coords(self):
+        return unpack_from('<{}h'.format(self.num_points * 2), self.buf, self.offset + self.header.size)
+
+    @property
+    def points(self):
+        coords = self.coords
+        return zip(coords[0::2], coords[1::2])
+
+    def fields(self):
+        # everything but the points, used to compare commands
+        return (self.type, self.stroke_color, self.stroke_width, self.fill_color, self.open, self.radius,
+                self.num_points)
+
+    def to_command(self):
+        # the equivalent svg2pdc command, which serializes to the same bytes
+        if self.type == DRAW_COMMAND_TYPE_CIRCLE:
+            command = svg2pdc.CircleCommand.__new__(svg2pdc.CircleCommand)
+            command.radius = self.radius
+        else:
+            command = svg2pdc.PathCommand.__new__(svg2pdc.PathCommand)
+            command.open = self.open
+            command.type = self.type
+        command.coords = array('h', self.coords)
+        command.stroke_color = self.stroke_color
+        command.stroke_width = self.stroke_width
+        command.fill_color = self.fill_color
+        return command
+
+    def __str__(self):
+        if self.type == DRAW_COMMAND_TYPE_CIRCLE:
+            return "Circle: [fill color:{}; stroke color:{}; stroke width:{}] {} {}".format(
+                self.fill_color, self.stroke_color, self.stroke_width, self.points[0], self.radius)
+        return "Path: [fill color:{}; stroke color:{}; stroke width:{}] {} {} {}".format(
+            self.fill_color, self.stroke_color, self.stroke_width, self.points, self.open,
+            'P' if self.type == DRAW_COMMAND_TYPE_PRECISE_PATH else '')
+
+
+class CommandList(object):
+    '''A serialized command list, iterating over it decodes one command at a time'''
+
+    def __init__(self, buf, offset):
+        if offset + COMMAND_LIST_HEADER.size > len(buf):
+            raise PDCFormatError("Command list at offset {} exceeds the file".format(offset))
+        self.buf = buf
+        self.offset = offset
+        self.num_commands = COMMAND_LIST_HEADER.unpack_from(buf, offset)[0]
+
+    def __len__(self):
+        return self.num_commands
+
+    def __iter__(self):
+        offset = self.offset + COMMAND_LIST_HEADER.size
+        for _ in range(self.num_commands):
+            command = DecodedCommand(self.buf, offset)
+            offset += command.size
+            yield command
+
+    @property
+    def end(self):
+        # walks the command headers only, circle and path headers have the same size and both end with the number
+        # of points
+        offset = self.offset + COMMAND_LIST_HEADER.size
+        for _ in range(self.num_commands):
+            if offset + PATH_HEADER.size > len(self.buf):
+                raise PDCFormatError("Command at offset {} exceeds the file".format(offset))
+            num_points = unpack_from('<H', self.buf, offset + PATH_HEADER.size - 2)[0]
+            offset += PATH_HEADER.size + num_points * POINT.size
+        return offset
+
+
+class Frame(object):
+    def __init__(self, buf, offset):
+        if offset + FRAME_HEADER.size > len(buf):
+            raise PDCFormatError("Frame at offset {} exceeds the file".format(offset))
+        self.offset = offset
+        self.duration = FRAME_HEADER.unpack_from(buf, offset)[0]
+        self.commands = CommandList(buf, offset + FRAME_HEADER.size)
+
+
+class PDCFile(object):
+    '''
+    A memory mapped PDC image or sequence. Use as a context manager, or call close() when done.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise PDCFormatError("{} is empty".format(path))
+        try:
+            self._read_header()
+        except PDCFormatError:
+            self.close()
+            raise
+
+    def _read_header(self):
+        buf = self.buf
+        if len(buf) < FILE_HEADER.size + IMAGE_HEADER.size:
+            raise PDCFormatError("{} is too short to be a PDC file".format(self.path))
+        self.magic, self.data_size = FILE_HEADER.unpack_from(buf, 0)
+        if self.magic not in ('PDCI', 'PDCS'):
+            raise PDCFormatError("{} has an unknown magic word {!r}".format(self.path, self.magic))
+        if FILE_HEADER.size + self.data_size != len(buf):
+            raise PDCFormatError("{} has a size of {} bytes in its header but {} bytes of data".format(
+                self.path, self.data_size, len(buf) - FILE_HEADER.size))
+
+        self.is_sequence = self.magic == 'PDCS'
+        if self.is_sequence:
+            if len(buf) < FILE_HEADER.size + SEQUENCE_HEADER.size:
+                raise PDCFormatError("{} is too short to be a PDC sequence".format(self.path))
+            (self.version, _, width, height, self.play_count,
+             self.num_frames) = SEQUENCE_HEADER.unpack_from(buf, FILE_HEADER.size)
+        else:
+            self.version, _, width, height = IMAGE_HEADER.unpack_from(buf, FILE_HEADER.size)
+            self.play_count = None
+            self.num_frames = None
+        self.size = (width, height)
+
+    def close(self):
+        self.buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def commands(self):
+        if self.is_sequence:
+            raise PDCFormatError("{} is a sequence, use frames".format(self.path))
+        return CommandList(self.buf, FILE_HEADER.size + IMAGE_HEADER.size)
+
+    def frames(self):
+        if not self.is_sequence:
+            raise PDCFormatError("{} is an image, use commands".format(self.path))
+        offset = FILE_HEADER.size + SEQUENCE_HEADER.size
+        for _ in range(self.num_frames):
+            frame = Frame(self.buf, offset)
+            yield frame
+            offset = frame.commands.end
+
+    def end(self):
+        # offset following the last command list, equal to the file size for well formed files
+        if self.is_sequence:
+            offset = FILE_HEADER.size + SEQUENCE_HEADER.size
+            for frame in self.frames():
+                offset = frame.commands.end
+            return offset
+        return self.commands.end
+
+    def reserialize(self):
+        # serializes the decoded content again with svg2pdc
+        if self.is_sequence:
+            frames = []
+            durations = []
+            for frame in self.frames():
+                frames.append([c.to_command() for c in frame.commands])
+                durations.append(frame.duration)
+            return svg2pdc.serialize_sequence(frames, self.size, None, self.play_count, durations=durations)
+        return svg2pdc.serialize_image([c.to_command() for c in self.commands], self.size)
+
+
+def compute_dirty_rects(pdc):
+    # the dirty rects sidecar svg2pdc.py --dirty-rects writes for the sequence
+    tracker = svg2pdc.DirtyRectTracker(pdc.size)
+    for frame in pdc.frames():
+        tracker.add([c.to_command() for c in frame.commands])
+    return svg2pdc.serialize_dirty_rects(tracker.get_rects())
+
+
+def verify_roundtrip(path):
+    '''
+    Checks that a file is well formed and that serializing its decoded content gives the same bytes. The dirty rects
+    sidecar of a sequence, if there is one, has to match its frames.
+    Returns a list of problems, empty if there are none.
+    '''
+    try:
+        with PDCFile(path) as pdc:
+            end = pdc.end()
+            if end != len(pdc.buf):
+                return ["{} has {} trailing bytes".format(path, len(pdc.buf) - end)]
+            if pdc.reserialize() != pdc.buf[:]:
+                return ["{} does not serialize to the same bytes".format(path)]
+            dirty_rects_path = svg2pdc.get_dirty_rects_path(path)
+            if pdc.is_sequence and os.path.exists(dirty_rects_path):
+                with open(dirty_rects_path, 'rb') as f:
+                    if f.read() != compute_dirty_rects(pdc):
+                        return ["{} does not match the frames of {}".format(dirty_rects_path, path)]
+    except (IOError, PDCFormatError) as e:
+        return [str(e)]
+    return []
+
+
+def diff_command_lists(prefix, commands1, commands2):
+    differences = []
+    if len(commands1) != len(commands2):
+        differences.append("{}: {} commands != {} commands".format(prefix, len(commands1), len(commands2)))
+    for i, (c1, c2) in enumerate(zip(commands1, commands2)):
+        if c1.fields() != c2.fields():
+            differences.append("{} command {}: {} != {}".format(prefix, i, c1, c2))
+        elif c1.raw_points[:] != c2.raw_points[:]:
+            moved = [(p1, p2) for p1, p2 in zip(c1.points, c2.points) if p1 != p2]
+            differences.append("{} command {}: {} points moved, first {} -> {}".format(prefix, i, len(moved),
+                                                                                      moved[0][0], moved[0][1]))
+    return differences
+
+
+def diff_pdc(path1, path2):
+    '''Structural differences between two PDC files, as a list of human readable strings'''
+    with PDCFile(path1) as pdc1, PDCFile(path2) as pdc2:
+        differences = []
+        for field in ('magic', 'version', 'size', 'play_count', 'num_frames'):
+            if getattr(pdc1, field) != getattr(pdc2, field):
+                differences.append("{}: {} != {}".format(field, getattr(pdc1, field), getattr(pdc2, field)))
+        if pdc1.magic != pdc2.magic:
+            return differences
+
+        if pdc1.is_sequence:
+            for i, (f1, f2) in enumerate(zip(pdc1.frames(), pdc2.frames())):
+                if f1.duration != f2.duration:
+                    differences.append("frame {} duration: {} != {}".format(i, f1.duration, f2.duration))
+                differences += diff_command_lists("frame {}".format(i), f1.commands, f2.commands)
+        else:
+            differences += diff_command_lists("image", pdc1.commands, pdc2.commands)
+        return differences
+
+
+def print_pdc(path):
+    with PDCFile(path) as pdc:
+        print "{}: {} version {}, size {}x{}".format(path, 'sequence' if pdc.is_sequence else 'image', pdc.version,
+                                                     pdc.size[0], pdc.size[1])
+        if pdc.is_sequence:
+            print "Play count: {}, frames: {}".format(pdc.play_count, pdc.num_frames)
+            for i, frame in enumerate(pdc.frames()):
+                print "Frame {} ({}ms):".format(i + 1, frame.duration)
+                for c in frame.commands:
+                    print str(c)
+        else:
+            for c in pdc.commands:
+                print str(c)
+
+
+def main(args):
+    failed = False
+    if args.diff:
+        if len(args.path) != 1:
+            print "--diff compares a single file"
+            sys.exit(2)
+        try:
+            differences = diff_pdc(args.path[0], args.diff)
+        except (IOError, PDCFormatError) as e:
+            # like diff, 2 means the files couldn't be compared at all
+            print e
+            sys.exit(2)
+        for d in differences:
+            print d
+        failed = bool(differences)
+    elif args.verify:
+        for path in args.path:
+            problems = verify_roundtrip(path)
+            for p in problems:
+                print p
+            failed = failed or bool(problems)
+        if not failed:
+            print "{} files verified".format(len(args.path))
+    else:
+        for path in args.path:
+            print_pdc(path)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, nargs='+',
+                        help="Path(s) to .pdc files")
+    parser.add_argument('--verify', action='store_true',
+                        help="Check that every file is well formed and serializes back to the same bytes")
+    parser.add_argument('--diff', type=str, metavar='OTHER',
+                        help="Print the structural differences between path and OTHER, exit with 1 if there are "
+                             "any and with 2 if a file can't be read")
+    args = parser.parse_args()
+    main(args)
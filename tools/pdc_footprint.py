@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Pebble Technology
+#
+'''
+PDC_FOOTPRINT reports how much room draw command resources take, without writing any output. For every resource it
+computes the exact serialized size of each command, frame and file, and estimates the heap used once the resource is
+loaded as a GDrawCommandImage or GDrawCommandSequence.
+
+gdraw_command_image_create_with_resource() and gdraw_command_sequence_create_with_resource() allocate the data
+following the 8 byte file header in a single block, so a loaded resource takes its data size plus the heap's block
+overhead. The total for a platform assumes all of its resources are loaded at the same time, plus the temporary
+clones of the largest image made while drawing (icon_layer_update_proc() clones the icon before transforming it).
+The totals are compared against per-platform budgets and the tool exits with EXIT_BUDGET_EXCEEDED when one is
+exceeded, so that callers can tell it apart from other failures.
+
+Resources are either given as paths (.pdc or .svg files, or directories of SVG frames for sequences) or read from
+the media of appinfo.json, resolving '~<platform>', '~color' and '~bw' file variants like the SDK does.
+'''
+
+import argparse
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import svg2pdc
+from pdc_decoder import PDCFile, PDCFormatError, DecodedCommand
+from svg2pdc import FILE_HEADER, IMAGE_HEADER, SEQUENCE_HEADER, FRAME_HEADER, COMMAND_LIST_HEADER
+
+HEAP_BLOCK_OVERHEAD = 8  # allocation header of the app heap
+HEAP_ALIGNMENT = 4
+
+# heap set aside for draw command resources, override with --budget. Apps get 24KB of memory on aplite and 64KB on
+# basalt and chalk, shared by the code, the static data and the heap. The budgets leave the draw command resources
+# about a sixth of that on aplite and a quarter on basalt and chalk, the rest goes to the app's code, its windows and
+# layers, and the text and bitmap resources
+DEFAULT_BUDGETS = {
+    'aplite': 4 * 1024,
+    'basalt': 16 * 1024,
+    'chalk': 16 * 1024,
+}
+
+COLOR_PLATFORMS = ['basalt', 'chalk']
+
+EXIT_ERROR = 1  # a resource or appinfo.json can't be read
+EXIT_BUDGET_EXCEEDED = 3  # 2 is taken by usage errors
+
+
+class FootprintError(Exception):
+    pass
+
+
+def heap_footprint(data_size):
+    return (data_size + HEAP_ALIGNMENT - 1) // HEAP_ALIGNMENT * HEAP_ALIGNMENT + HEAP_BLOCK_OVERHEAD
+
+
+def command_footprint(command):
+    # works for svg2pdc and decoded commands alike
+    if isinstance(command, DecodedCommand):
+        size = command.size
+    else:
+        size = command.serialized_size()
+    kind = 'circle' if getattr(command, 'radius', None) is not None else 'path'
+    return {'type': kind, 'points': command.num_points, 'size': size}
+
+
+def command_list_footprint(commands):
+    commands = [command_footprint(c) for c in commands]
+    return {'size': COMMAND_LIST_HEADER.size + sum(c['size'] for c in commands), 'commands': commands}
+
+
+def resource_footprint(path, size, image=None, frames=None):
+    '''
+    Footprint of an image (a command list) or a sequence (a list of command lists) of the given resource.
+    '''
+    if frames is None:
+        footprint = command_list_footprint(image)
+        data_size = IMAGE_HEADER.size + footprint['size']
+        footprint = {'commands': footprint['commands']}
+    else:
+        frame_footprints = []
+        for frame in frames:
+            f = command_list_footprint(frame)
+            f['size'] += FRAME_HEADER.size
+            frame_footprints.append(f)
+        data_size = SEQUENCE_HEADER.size + sum(f['size'] for f in frame_footprints)
+        footprint = {'frames': frame_footprints}
+    footprint.update({
+        'path': path,
+        'sequence': frames is not None,
+        'width': int(round(size[0])),
+        'height': int(round(size[1])),
+        'file_size': FILE_HEADER.size + data_size,
+        'data_size': data_size,
+        'heap': heap_footprint(data_size),
+    })
+    return footprint
+
+
+def analyze_path(path, precise=False):
+    try:
+        return _analyze_path(path, precise)
+    except ET.ParseError as e:
+        raise FootprintError("{} is not a valid SVG: {}".format(path, e))
+
+
+def _analyze_path(path, precise):
+    if os.path.isdir(path):
+        sequence = svg2pdc.parse_svg_sequence(path, precise)
+        if sequence is None:
+            raise FootprintError("{} has no .svg frames".format(path))
+        size, frames, _ = sequence
+        return resource_footprint(path, size, frames=frames)
+    if path.lower().endswith('.svg'):
+        size, commands, _ = svg2pdc.parse_svg_image(path, precise)
+        return resource_footprint(path, size, image=commands)
+
+    with PDCFile(path) as pdc:
+        if pdc.is_sequence:
+            footprint = resource_footprint(path, pdc.size, frames=[f.commands for f in pdc.frames()])
+        else:
+            footprint = resource_footprint(path, pdc.size, image=pdc.commands)
+        if footprint['data_size'] != pdc.data_size:
+            raise FootprintError("{} has a size of {} bytes in its header but its commands take {} bytes".format(
+                path, pdc.data_size, footprint['data_size']))
+        return footprint
+
+
+def resolve_resource_file(resources_dir, file_name, platform):
+    # the most specific variant wins: file~<platform>.ext, then file~color.ext or file~bw.ext, then file.ext
+    root, ext = os.path.splitext(file_name)
+    tags = [platform, 'color' if platform in COLOR_PLATFORMS else 'bw']
+    for tag in tags:
+        path = os.path.join(resources_dir, '{}~{}{}'.format(root, tag, ext))
+        if os.path.exists(path):
+            return path
+    return os.path.join(resources_dir, file_name)
+
+
+def get_appinfo_resources(appinfo_path):
+    '''
+    Returns the target platforms of appinfo.json and, for each of them, the paths of its draw command resources.
+    '''
+    with open(appinfo_path) as f:
+        appinfo = json.load(f)
+    resources_dir = os.path.join(os.path.dirname(os.path.abspath(appinfo_path)), 'resources')
+    platforms = appinfo.get('targetPlatforms', ['aplite', 'basalt'])
+    resources = {}
+    for platform in platforms:
+        resources[platform] = []
+        for media in appinfo.get('resources', {}).get('media', []):
+            if not media['file'].lower().endswith('.pdc'):
+                continue
+            if platform not in media.get('targetPlatforms', platforms):
+                continue
+            resources[platform].append(resolve_resource_file(resources_dir, media['file'], platform))
+    return platforms, resources
+
+
+def platform_total(footprints, draw_copies):
+    images = [f['heap'] for f in footprints if not f['sequence']]
+    return sum(f['heap'] for f in footprints) + draw_copies * max(images or [0])
+
+
+def check_budgets(totals, budgets):
+    # returns a message for every platform over its budget
+    problems = []
+    for platform, total in sorted(totals.items()):
+        budget = budgets.get(platform)
+        if budget is not None and total > budget:
+            problems.append("{}: draw command resources take {} bytes of heap, {} bytes over the budget of {} "
+                            "bytes".format(platform, total, total - budget, budget))
+    return problems
+
+
+def print_footprint(footprint, verbose=False, top=0):
+    print "{}: {} {}x{}, {} bytes serialized, ~{} bytes of heap".format(
+        footprint['path'], 'sequence' if footprint['sequence'] else 'image', footprint['width'],
+        footprint['height'], footprint['file_size'], footprint['heap'])
+
+    if footprint['sequence']:
+        lists = [('frame {}'.format(i), f) for i, f in enumerate(footprint['frames'])]
+    else:
+        lists = [('', footprint)]
+    commands = []
+    for name, command_list in lists:
+        if verbose and name:
+            print "  {}: {} bytes, {} commands".format(name, command_list['size'], len(command_list['commands']))
+        for i, c in enumerate(command_list['commands']):
+            label = '{} command {}'.format(name, i).strip()
+            commands.append((c['size'], label, c))
+            if verbose:
+                print "    {}: {} with {} points, {} bytes".format(label, c['type'], c['points'], c['size'])
+    if top:
+        for size, label, c in sorted(commands, key=lambda entry: -entry[0])[:top]:
+            print "  largest: {}: {} with {} points, {} bytes".format(label, c['type'], c['points'], size)
+
+
+def parse_budgets(values):
+    budgets = dict(DEFAULT_BUDGETS)
+    for value in values or []:
+        try:
+            platform, budget = value.split('=')
+            budgets[platform] = int(budget)
+        except ValueError:
+            raise FootprintError("Invalid budget '{}', expected PLATFORM=BYTES".format(value))
+    return budgets
+
+
+def main(args):
+    budgets = parse_budgets(args.budget)
+    if args.path:
+        platforms = args.platform or ['aplite', 'basalt']
+        resources = dict((platform, args.path) for platform in platforms)
+    else:
+        platforms, resources = get_appinfo_resources(args.appinfo)
+        platforms = args.platform or platforms
+
+    footprints = {}  # by path, resources shared between platforms are only analyzed once
+    totals = {}
+    for platform in platforms:
+        print "{}:".format(platform)
+        platform_footprints = []
+        for path in resources.get(platform, []):
+            if path not in footprints:
+                footprints[path] = analyze_path(path, args.precise)
+            platform_footprints.append(footprints[path])
+            print_footprint(footprints[path], args.verbose, args.top)
+        totals[platform] = platform_total(platform_footprints, args.draw_copies)
+        print "{} total: ~{} bytes of heap (budget {})".format(platform, totals[platform],
+                                                                budgets.get(platform, 'none'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'resources': footprints, 'totals': totals, 'budgets': budgets}, f, indent=2, sort_keys=True)
+
+    problems = check_budgets(totals, budgets)
+    for problem in problems:
+        print problem
+    sys.exit(EXIT_BUDGET_EXCEEDED if problems else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, nargs='*',
+                        help="Path(s) to .pdc or .svg files, or directories of SVG frames (default: the resources "
+                             "of --appinfo)")
+    parser.add_argument('-a', '--appinfo', type=str, default='appinfo.json',
+                        help="appinfo.json to read the resources and target platforms from - default = appinfo.json")
+    parser.add_argument('--platform', type=str, action='append',
+                        help="Only check this platform (can be given several times)")
+    parser.add_argument('-b', '--budget', type=str, action='append',
+                        help="Heap budget of a platform as PLATFORM=BYTES (can be given several times) - defaults: " +
+                             ', '.join('{}={}'.format(p, b) for p, b in sorted(DEFAULT_BUDGETS.items())))
+    parser.add_argument('--draw-copies', type=int, default=1,
+                        help="Number of temporary clones of an image made while drawing - default = 1")
+    parser.add_argument('-p', '--precise', action='store_true',
+                        help="Use sub-pixel precision for paths of SVG files")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Print the size of every frame and command")
+    parser.add_argument('--top', type=int, default=0,
+                        help="Print the N largest commands of every resource")
+    parser.add_argument('--json', type=str,
+                        help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+    try:
+        main(args)
+    except (FootprintError, PDCFormatError, IOError) as e:
+        print e
+        sys.exit(EXIT_ERROR)
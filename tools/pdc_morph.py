@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Pebble Technology
+#
+'''
+PDC_MORPH precomputes the attract-to-square icon transition of src/gdraw_command_transforms.c offline. It takes an
+.svg or a .pdc image and a list of normalized animation steps, applies gpoint_attract_to_square() to every point with
+the same 16 bit fixed point math as the watch, and writes the resulting frames as a PDCS sequence. The app can then
+play the sequence instead of transforming every point on every animation frame.
+
+Steps are given in the range 0.0 - 1.0 and converted to the watch's fixed point range (0 - ANIMATION_NORMALIZED_MAX).
+Like on the watch, the transform is applied to the raw point values, so precise paths (1/8 pixel units) are
+transformed exactly as gdraw_command_set_point() would store them.
+'''
+
+import argparse
+import copy
+import os
+import xml.etree.ElementTree as ET
+from array import array
+
+import svg2pdc
+from pdc_decoder import PDCFile, PDCFormatError
+
+ANIMATION_NORMALIZED_MAX = 65535
+
+
+def _int16(value):
+    # C cast to int16_t
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def _c_div(a, b):
+    # C integer division truncates towards zero
+    quotient = abs(a) // abs(b)
+    return quotient if (a >= 0) == (b > 0) else -quotient
+
+
+def int_attract_to(i, bounds, normalized):
+    '''port of prv_int_attract_to()'''
+    delta_0 = _int16((0 + 1) - i)
+    delta_b = _int16((bounds - 1) - i)
+    delta = delta_0 if abs(delta_0) < abs(delta_b) else delta_b
+    return _int16(i + _c_div(delta * normalized, ANIMATION_NORMALIZED_MAX))
+
+
+def gpoint_attract_to_square(point, size, normalized):
+    '''port of gpoint_attract_to_square()'''
+    x, y = point
+    y = _int16(y + 1)
+    return int_attract_to(x, size[0], normalized), int_attract_to(y, size[1], normalized)
+
+
+def attract_commands_to_square(commands, size, normalized):
+    '''
+    Returns copies of the commands with gpoint_attract_to_square() applied to all points, like
+    attract_draw_command_list_to_square().
+    '''
+    attracted = []
+    for c in commands:
+        c = copy.copy(c)
+        coords = array('h')
+        for point in c.points:
+            coords.extend(gpoint_attract_to_square(point, size, normalized))
+        c.coords = coords
+        attracted.append(c)
+    return attracted
+
+
+def normalize_step(step):
+    if not 0.0 <= step <= 1.0:
+        raise ValueError("Steps must be in the range 0.0 - 1.0, got {}".format(step))
+    return int(round(step * ANIMATION_NORMALIZED_MAX))
+
+
+def get_steps(frames, bounce=False):
+    # evenly spaced steps from the original icon (0.0) to the square (1.0), and optionally back
+    steps = [float(i) / (frames - 1) for i in range(frames)] if frames > 1 else [1.0]
+    if bounce:
+        steps += steps[-2::-1]
+    return steps
+
+
+def morph_frames(commands, size, steps):
+    size = (int(round(size[0])), int(round(size[1])))
+    return [attract_commands_to_square(commands, size, normalize_step(step)) for step in steps]
+
+
+def load_image(path, precise=False):
+    # returns the size and the (svg2pdc) commands of an .svg or .pdc image
+    if path.lower().endswith('.svg'):
+        try:
+            size, commands, error = svg2pdc.parse_svg_image(path, precise)
+        except ET.ParseError as e:
+            raise PDCFormatError("{} is not a valid SVG: {}".format(path, e))
+    else:
+        with PDCFile(path) as pdc:
+            if pdc.is_sequence:
+                raise PDCFormatError("{} is a sequence, morphs are built from images".format(path))
+            size, commands = pdc.size, [c.to_command() for c in pdc.commands]
+    if not commands:
+        raise PDCFormatError("{} has nothing to draw".format(path))
+    return size, commands
+
+
+def create_morph_sequence(path, steps, duration, play_count, precise=False, merge_threshold=None):
+    size, commands = load_image(path, precise)
+    frames = morph_frames(commands, size, steps)
+    return svg2pdc.build_sequence(frames, size, duration, play_count, merge_threshold=merge_threshold)
+
+
+def main(args):
+    steps = args.steps if args.steps else get_steps(args.frames, args.bounce)
+    if args.steps and args.bounce:
+        steps += steps[-2::-1]
+    output = create_morph_sequence(args.path, steps, args.duration, args.play_count, args.precise,
+                                   0 if args.merge_frames else None)
+
+    out_path = args.output
+    if out_path is None:
+        out_path = os.path.splitext(args.path)[0] + '_to_square.pdc'
+    svg2pdc.write_atomic(out_path, output)
+    print "{}: {} frames".format(out_path, len(steps))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str,
+                        help="Path to the .svg or .pdc image")
+    parser.add_argument('-o', '--output', type=str,
+                        help="Output .pdc file (default: <image>_to_square.pdc next to the image)")
+    parser.add_argument('--steps', type=float, nargs='+',
+                        help="Normalized steps (0.0 - 1.0) of the frames, 0.0 is the original image and 1.0 the square")
+    parser.add_argument('-f', '--frames', type=int, default=10,
+                        help="Number of evenly spaced steps from 0.0 to 1.0, if no --steps are given - default = 10")
+    parser.add_argument('-b', '--bounce', action='store_true',
+                        help="Animate back to the original image after reaching the last step")
+    parser.add_argument('-d', '--duration', type=int, default=33,
+                        help="Duration (ms) of each frame - default = 33ms")
+    parser.add_argument('-c', '--play_count', type=int, default=1,
+                        help="Number of times the sequence should play - default = 1")
+    parser.add_argument('-p', '--precise', action='store_true',
+                        help="Use sub-pixel precision for paths of .svg images")
+    parser.add_argument('-m', '--merge-frames', action='store_true',
+                        help="Merge consecutive identical frames into longer frames")
+    args = parser.parse_args()
+    if args.frames < 1:
+        parser.error("--frames must be at least 1")
+    if args.steps and not all(0.0 <= step <= 1.0 for step in args.steps):
+        parser.error("--steps must be in the range 0.0 - 1.0")
+    try:
+        main(args)
+    except (IOError, PDCFormatError) as e:
+        parser.error(str(e))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Pebble Technology
+#
+'''
+PDC_PACK packs several images into a single resource, so that an app can get to any of them through one resource
+handle, and generates a C header with the offset and length of every image.
+
+Pack format:
+| 4     | Magic word 'PDCP'
+| 4     | Size of the pack following these 8 bytes
+| 2     | Number of images
+Followed by the index, one entry per image:
+| 4     | Offset of the image data from the start of the pack
+| 4     | Length of the image data
+Followed by the image data.
+
+The image data of an entry is what follows the 'PDCI' file header of a .pdc file (the data that
+gdraw_command_image_create_with_resource() loads), so a range of the pack can be loaded straight into a
+GDrawCommandImage. The per-file headers are replaced by the index, and identical images share their bytes.
+
+Commands are not shared between different images: an image has to be contiguous to be loaded with one
+resource_load_byte_range() call, and the icons of this app have almost no commands in common (3 of 69). The pack is
+about the size of the separate files, what it saves is the resource handle lookups and allocations per icon.
+'''
+
+import argparse
+import os
+import re
+import xml.etree.ElementTree as ET
+from struct import Struct
+
+import svg2pdc
+from svg2pdc import FILE_HEADER
+from pdc_decoder import PDCFile, PDCFormatError
+
+PACK_MAGIC = 'PDCP'
+PACK_COUNT = Struct('<H')
+PACK_INDEX_ENTRY = Struct('<II')  # offset, length
+
+
+def load_image_data(path, precise=False):
+    # returns the image data (without file header) of an .svg or .pdc image
+    if path.lower().endswith('.svg'):
+        try:
+            size, commands, error = svg2pdc.parse_svg_image(path, precise)
+        except ET.ParseError as e:
+            raise PDCFormatError("{} is not a valid SVG: {}".format(path, e))
+        if not commands:
+            raise PDCFormatError("{} has nothing to draw".format(path))
+        return svg2pdc.serialize_image(commands, size)[FILE_HEADER.size:]
+
+    with PDCFile(path) as pdc:
+        if pdc.is_sequence:
+            raise PDCFormatError("{} is a sequence, only images can be packed".format(path))
+        if not len(pdc.commands):
+            raise PDCFormatError("{} has nothing to draw".format(path))
+        return pdc.buf[FILE_HEADER.size:]
+
+
+def layout_pack(images):
+    '''
+    Places the images in a single data block in index order, storing identical images once.
+    Returns the data block and the (offset, length) of every image within it.
+    '''
+    data = []
+    data_size = 0
+    offsets = {}  # image data -> offset
+    ranges = []
+    for image in images:
+        if image not in offsets:
+            offsets[image] = data_size
+            data.append(image)
+            data_size += len(image)
+        ranges.append((offsets[image], len(image)))
+    return ''.join(data), ranges
+
+
+def build_pack(images):
+    # returns the serialized pack and the (offset, length) of every image within it
+    data, ranges = layout_pack(images)
+    header_size = FILE_HEADER.size + PACK_COUNT.size + PACK_INDEX_ENTRY.size * len(images)
+    ranges = [(header_size + offset, length) for offset, length in ranges]
+    output = PACK_COUNT.pack(len(images))
+    output += ''.join(PACK_INDEX_ENTRY.pack(offset, length) for offset, length in ranges)
+    output += data
+    return FILE_HEADER.pack(PACK_MAGIC, len(output)) + output, ranges
+
+
+def read_pack(buf):
+    # returns the image data of every entry of a pack
+    magic, size = FILE_HEADER.unpack_from(buf, 0)
+    if magic != PACK_MAGIC or FILE_HEADER.size + size != len(buf):
+        raise PDCFormatError("Not a well formed image pack")
+    count = PACK_COUNT.unpack_from(buf, FILE_HEADER.size)[0]
+    images = []
+    for i in range(count):
+        offset, length = PACK_INDEX_ENTRY.unpack_from(buf, FILE_HEADER.size + PACK_COUNT.size +
+                                                      i * PACK_INDEX_ENTRY.size)
+        if offset + length > len(buf):
+            raise PDCFormatError("Image {} exceeds the pack".format(i))
+        images.append(buf[offset:offset + length])
+    return images
+
+
+def get_names(paths):
+    # C identifiers from the file names, without the prefix common to all of them (e.g. PEBBLE_50X50_)
+    names = [re.sub(r'[^A-Z0-9]+', '_', os.path.splitext(os.path.basename(p))[0].upper()).strip('_') for p in paths]
+    prefix = os.path.commonprefix(names)
+    prefix = prefix[:prefix.rfind('_') + 1]
+    if len(names) > 1 and all(len(n) > len(prefix) for n in names):
+        names = [n[len(prefix):] for n in names]
+    names = [n if not n[:1].isdigit() else '_' + n for n in names]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise ValueError("Images with the same name: {}".format(', '.join(duplicates)))
+    return names
+
+
+def generate_header(prefix, names, ranges, pack_size):
+    lines = ['// Generated by tools/pdc_pack.py, do not edit',
+             '',
+             '#pragma once',
+             '',
+             '#include <pebble.h>',
+             '',
+             '#define {}_PACK_SIZE {}'.format(prefix, pack_size),
+             '#define {}_PACK_COUNT {}'.format(prefix, len(names)),
+             '// size of a buffer that fits any image, so one buffer can be reused for all of them',
+             '#define {}_PACK_MAX_LENGTH {}'.format(prefix, max(length for _, length in ranges)),
+             '']
+    for i, (name, (offset, length)) in enumerate(zip(names, ranges)):
+        lines.append('#define {}_{}_INDEX {}'.format(prefix, name, i))
+        lines.append('#define {}_{}_OFFSET {}'.format(prefix, name, offset))
+        lines.append('#define {}_{}_LENGTH {}'.format(prefix, name, length))
+    lines += ['',
+              '// offset and length of every image, load a range with resource_load_byte_range()',
+              'static const struct {',
+              '  uint32_t offset;',
+              '  uint32_t length;',
+              '}} {}_PACK_INDEX[] = {{'.format(prefix)]
+    lines += ['  {{ {}, {} }},  // {}'.format(offset, length, name) for name, (offset, length) in zip(names, ranges)]
+    lines += ['};', '']
+    return '\n'.join(lines)
+
+
+def main(args):
+    names = get_names(args.path)
+    images = [load_image_data(path, args.precise) for path in args.path]
+    output, ranges = build_pack(images)
+    if read_pack(output) != images:
+        raise PDCFormatError("Pack does not read back the packed images")
+    svg2pdc.write_if_changed(args.output, output)
+
+    header_path = args.header or os.path.splitext(args.output)[0] + '.h'
+    header = generate_header(args.prefix.upper(), names, ranges, len(output))
+    svg2pdc.write_if_changed(header_path, header)
+
+    separate = sum(FILE_HEADER.size + len(image) for image in images)
+    print "{}: {} images, {} bytes ({} bytes as separate files)".format(args.output, len(images), len(output),
+                                                                         separate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, nargs='+',
+                        help="Paths to the .svg or .pdc images to pack, in index order")
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help="Output pack file")
+    parser.add_argument('--header', type=str,
+                        help="Output C header (default: the output path with a .h extension)")
+    parser.add_argument('--prefix', type=str, default='ICON',
+                        help="Prefix of the names defined in the C header - default = ICON")
+    parser.add_argument('-p', '--precise', action='store_true',
+                        help="Use sub-pixel precision for paths of .svg images")
+    args = parser.parse_args()
+    try:
+        get_names(args.path)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        main(args)
+    except (IOError, PDCFormatError) as e:
+        parser.error(str(e))
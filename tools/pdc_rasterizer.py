@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Pebble Technology
+#
+'''
+PDC_RASTERIZER renders draw commands offline, without building the app and running it in the emulator. It takes
+svg2pdc command lists, decoded .pdc files (see pdc_decoder.py) or .svg files and renders them into RGBA buffers at
+Pebble resolution, using the 64 color Pebble palette. Every pixel of a command is computed at once with NumPy.
+
+Sequences are rendered into a contact sheet holding all of their frames. Renders can be written as PNG files or
+compared pixel by pixel against reference .pdc or .png files, for quick regression checks of a whole resource directory.
+
+The rasterizer approximates the firmware: pixel centers are sampled, fills use the even-odd rule, strokes have
+round caps and joins, and alpha is blended in the 2 bit steps of the palette. It's meant for previews and for
+spotting changes, not as a pixel exact reference of the firmware.
+'''
+
+import argparse
+import math
+import os
+import sys
+import zlib
+from struct import pack, unpack_from
+
+import numpy
+
+import svg2pdc
+from pdc_decoder import PDCFile, PDCFormatError
+from pebble_image_routines import pebble_get_64color_palette
+
+PALETTE = numpy.array(pebble_get_64color_palette(), dtype=numpy.float64)
+
+# a reference for foo.svg or foo.pdc is foo.pdc (rendered like the input) or foo.png (a render written by this tool)
+REFERENCE_EXTENSIONS = ['.pdc', '.png']
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+
+def argb8_to_rgba(argb8):
+    # returns the palette color and its opacity (0.0 - 1.0) of an ARGB8 color
+    return PALETTE[argb8 & 0x3F], (argb8 >> 6) / 3.0
+
+
+def _paint(canvas, mask, argb8):
+    rgb, alpha = argb8_to_rgba(argb8)
+    if alpha == 0 or not mask.any():
+        return
+    pixels = canvas[mask]
+    pixels[:, :3] = pixels[:, :3] * (1 - alpha) + rgb * alpha
+    pixels[:, 3] = alpha + pixels[:, 3] * (1 - alpha)
+    canvas[mask] = pixels
+
+
+def polygon_mask(points, xs, ys):
+    # even-odd rule, sampled at the pixel centers
+    inside = numpy.zeros(xs.shape, dtype=bool)
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = numpy.roll(x0, -1), numpy.roll(y0, -1)
+    for ax, ay, bx, by in zip(x0, y0, x1, y1):
+        if ay == by:
+            continue
+        crosses = (ay <= ys) != (by <= ys)
+        x_intersection = ax + (ys - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (xs < x_intersection)
+    return inside
+
+
+def stroke_mask(points, path_open, stroke_width, xs, ys):
+    # pixels within half the stroke width of any segment (round caps and joins)
+    radius = max(stroke_width, 1) / 2.0
+    mask = numpy.zeros(xs.shape, dtype=bool)
+    segments = zip(points[:-1], points[1:])
+    if not path_open and len(points) > 2:
+        segments.append((points[-1], points[0]))
+    if len(points) == 1:
+        segments = [(points[0], points[0])]
+    for a, b in segments:
+        d = b - a
+        length_squared = d.dot(d)
+        if length_squared == 0:
+            t = 0.0
+        else:
+            t = numpy.clip(((xs - a[0]) * d[0] + (ys - a[1]) * d[1]) / length_squared, 0.0, 1.0)
+        mask |= numpy.hypot(xs - (a[0] + t * d[0]), ys - (a[1] + t * d[1])) <= radius
+    return mask
+
+
+def render_commands(commands, size, background=0):
+    '''
+    Renders svg2pdc or decoded commands into a HxWx4 uint8 RGBA buffer of the given (width, height).
+    background is the ARGB8 color of the canvas, transparent by default.
+    '''
+    width, height = int(round(size[0])), int(round(size[1]))
+    canvas = numpy.zeros((height, width, 4), dtype=numpy.float64)
+    _paint(canvas, numpy.ones((height, width), dtype=bool), background)
+    ys, xs = numpy.mgrid[0:height, 0:width].astype(numpy.float64)
+
+    for c in commands:
+        radius = getattr(c, 'radius', None)
+        points = numpy.array(c.points, dtype=numpy.float64).reshape(-1, 2)
+        if radius is not None:
+            distance = numpy.hypot(xs - points[0, 0], ys - points[0, 1])
+            if c.fill_color:
+                _paint(canvas, distance <= radius, c.fill_color)
+            if c.stroke_color and c.stroke_width:
+                _paint(canvas, numpy.abs(distance - radius) <= max(c.stroke_width, 1) / 2.0, c.stroke_color)
+            continue
+
+        if getattr(c, 'type', None) == svg2pdc.DRAW_COMMAND_TYPE_PRECISE_PATH:
+            points /= 8.0
+        if c.fill_color and len(points) > 2:
+            _paint(canvas, polygon_mask(points, xs, ys), c.fill_color)
+        if c.stroke_color and c.stroke_width and len(points):
+            _paint(canvas, stroke_mask(points, c.open, c.stroke_width, xs, ys), c.stroke_color)
+
+    rgba = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    rgba[..., :3] = numpy.round(canvas[..., :3])
+    rgba[..., 3] = numpy.round(canvas[..., 3] * 255)
+    return rgba
+
+
+def contact_sheet(images, columns=None, gap=1):
+    # arranges equally sized images into a grid, row by row
+    if not images:
+        return numpy.zeros((0, 0, 4), dtype=numpy.uint8)
+    columns = columns or int(math.ceil(math.sqrt(len(images))))
+    rows = int(math.ceil(len(images) / float(columns)))
+    height, width = images[0].shape[:2]
+    sheet = numpy.zeros((rows * (height + gap) - gap, columns * (width + gap) - gap, 4), dtype=numpy.uint8)
+    for i, image in enumerate(images):
+        y = (i // columns) * (height + gap)
+        x = (i % columns) * (width + gap)
+        sheet[y:y + height, x:x + width] = image
+    return sheet
+
+
+def render_file(path, columns=None):
+    '''
+    Renders a .pdc or .svg file. Images are returned as is, sequences as a contact sheet of all frames.
+    '''
+    if path.lower().endswith('.svg'):
+        size, commands, _ = svg2pdc.parse_svg_image(path)
+        return render_commands(commands, size)
+
+    with PDCFile(path) as pdc:
+        if not pdc.is_sequence:
+            return render_commands(pdc.commands, pdc.size)
+        return contact_sheet([render_commands(frame.commands, pdc.size) for frame in pdc.frames()], columns)
+
+
+def diff_images(image1, image2):
+    # number of differing pixels, images of different sizes differ everywhere
+    if image1.shape != image2.shape:
+        return max(image1.shape[0] * image1.shape[1], image2.shape[0] * image2.shape[1])
+    return int((image1 != image2).any(axis=-1).sum())
+
+
+def upscale(rgba, scale):
+    if scale > 1:
+        rgba = rgba.repeat(scale, axis=0).repeat(scale, axis=1)
+    return rgba
+
+
+def write_png(path, rgba, scale=1):
+    rgba = upscale(rgba, scale)
+    height, width = rgba.shape[:2]
+    raw = ''.join('\x00' + rgba[y].tostring() for y in range(height))  # filter type 0 for every row
+
+    def chunk(tag, data):
+        return pack('>I', len(data)) + tag + data + pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk('IHDR', pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))  # 8 bit RGBA
+        f.write(chunk('IDAT', zlib.compress(raw, 9)))
+        f.write(chunk('IEND', ''))
+
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def read_png(path):
+    '''
+    Reads an 8 bit RGB or RGBA, non interlaced PNG file (as written by write_png) into a HxWx4 uint8 RGBA buffer.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("{} is not a PNG file".format(path))
+
+    header, idat, offset = None, [], len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, tag = unpack_from('>I4s', data, offset)
+        if tag == 'IHDR':
+            header = unpack_from('>IIBBBBB', data, offset + 8)
+        elif tag == 'IDAT':
+            idat.append(data[offset + 8:offset + 8 + length])
+        offset += length + 12
+    if header is None:
+        raise ValueError("{} has no IHDR chunk".format(path))
+    width, height, depth, color_type, _, _, interlace = header
+    if depth != 8 or color_type not in (2, 6) or interlace:
+        raise ValueError("{} is not an 8 bit RGB(A) non interlaced PNG".format(path))
+
+    channels = 4 if color_type == 6 else 3
+    stride = width * channels
+    raw = bytearray(zlib.decompress(''.join(idat)))
+    pixels = bytearray(height * stride)
+    previous = bytearray(stride)
+    for y in range(height):
+        filter_type = raw[y * (stride + 1)]
+        row = raw[y * (stride + 1) + 1:(y + 1) * (stride + 1)]
+        for x in (range(stride) if filter_type else []):
+            a = row[x - channels] if x >= channels else 0
+            b = previous[x]
+            c = previous[x - channels] if x >= channels else 0
+            if filter_type == 1:
+                row[x] = (row[x] + a) & 0xFF
+            elif filter_type == 2:
+                row[x] = (row[x] + b) & 0xFF
+            elif filter_type == 3:
+                row[x] = (row[x] + ((a + b) >> 1)) & 0xFF
+            elif filter_type == 4:
+                row[x] = (row[x] + _paeth(a, b, c)) & 0xFF
+        pixels[y * stride:(y + 1) * stride] = row
+        previous = row
+
+    image = numpy.frombuffer(bytes(pixels), dtype=numpy.uint8).reshape(height, width, channels)
+    if channels == 4:
+        return image.copy()
+    rgba = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    rgba[..., :3] = image
+    rgba[..., 3] = 255
+    return rgba
+
+
+def find_reference(reference_dir, path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    for ext in REFERENCE_EXTENSIONS:
+        reference_path = os.path.join(reference_dir, name + ext)
+        if os.path.isfile(reference_path):
+            return reference_path
+    return None
+
+
+def main(args):
+    failed = False
+    for path in args.path:
+        image = render_file(path, args.columns)
+        if args.reference_dir:
+            reference_path = find_reference(args.reference_dir, path)
+            if reference_path is None:
+                failed = True
+                print "{}: no reference in {}".format(path, args.reference_dir)
+                continue
+            try:
+                if reference_path.lower().endswith('.png'):
+                    # written with --scale, so compare against the render at the same scale
+                    reference = read_png(reference_path)
+                    differences = diff_images(upscale(image, args.scale), reference)
+                else:
+                    differences = diff_images(image, render_file(reference_path, args.columns))
+            except (IOError, ValueError, PDCFormatError) as e:
+                failed = True
+                print "{}: could not read reference {}: {}".format(path, reference_path, e)
+                continue
+            if differences > args.threshold:
+                failed = True
+                print "{}: {} pixels differ from {}".format(path, differences, reference_path)
+            continue
+
+        if args.output and len(args.path) == 1:
+            out_path = args.output
+        else:
+            out_dir = args.output or os.path.dirname(path)
+            out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + '.png')
+        write_png(out_path, image, args.scale)
+
+    if args.reference_dir and not failed:
+        print "{} files match".format(len(args.path))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, nargs='+',
+                        help="Path(s) to .pdc or .svg files")
+    parser.add_argument('-o', '--output', type=str,
+                        help="Output .png file for a single path, or output directory for several paths (default: "
+                             "next to each input)")
+    parser.add_argument('--scale', type=int, default=1,
+                        help="Integer upscaling of the written images - default = 1")
+    parser.add_argument('--columns', type=int,
+                        help="Number of frames per row in sequence contact sheets - default = square sheet")
+    parser.add_argument('-r', '--reference-dir', type=str,
+                        help="Instead of writing images, compare every render against the .pdc or .png file with the "
+                             "same name in this directory (.png references are compared at --scale) and fail if they "
+                             "differ or are missing")
+    parser.add_argument('--threshold', type=int, default=0,
+                        help="Number of differing pixels tolerated by --reference-dir - default = 0")
+    args = parser.parse_args()
+    main(args)
@@ -5,6 +5,9 @@
 
 import math
 
+numpy = None  # imported on first use, see _get_numpy
+_numpy_checked = False
+
 # This module contains common image and color routines used to convert images
 # for use with Pebble.
 
@@ -59,6 +62,88 @@ def rgba32_triplet_to_argb8(r, g, b, a):
     return argb8
 
 
+# lookup tables mapping an 8-bit channel value to the 2-bit channel value of the
+# truncated or nearest color in the pebble palette
+PEBBLE_TRUNCATE_2BIT_LUT = [((v / 85) * 85) >> 6 for v in xrange(256)]
+PEBBLE_NEAREST_2BIT_LUT = [(((v + 42) / 85) * 85) >> 6 for v in xrange(256)]
+
+
+# converts a rgba32 color straight to ARGB8 using the lookup tables, same result as
+# rgba32_triplet_to_argb8(*pebble_truncate_color_to_pebble_palette(r, g, b, a))
+# (or pebble_nearest_color_to_pebble_palette when truncate is False)
+def pebble_rgba32_to_argb8(r, g, b, a, truncate=True):
+    lut = PEBBLE_TRUNCATE_2BIT_LUT if truncate else PEBBLE_NEAREST_2BIT_LUT
+    a = lut[a]
+    if a == 0:
+        return 0  # transparent pixels are cleared
+    return (a << 6) | (lut[r] << 4) | (lut[g] << 2) | lut[b]
+
+
+# converts a rgba32 color to the black and white palette of 1-bit displays: black or
+# white by (integer Rec. 601) luminance, cleared when less than half opaque
+def pebble_rgba32_to_bw_argb8(r, g, b, a):
+    if a < 128:
+        return 0
+    return 0xFF if 299 * r + 587 * g + 114 * b >= 127500 else 0xC0
+
+
+# numpy is slow to import and only needed for whole pixel buffers, so it is imported
+# the first time one is quantized; returns None if numpy isn't installed
+def _get_numpy():
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+# quantizes a whole rgba32 pixel buffer to the pebble palette in one pass
+# pixels is either a HxWx4 uint8 numpy array or a raw bytes/memoryview buffer of
+# rgba32 pixels; returns the quantized rgba32 buffer and the ARGB8 buffer (1 byte
+# per pixel), as numpy arrays shaped like the input or as bytes for raw buffers
+def pebble_quantize_rgba32_buffer(pixels, truncate=True):
+    if _get_numpy() is None:
+        return _pebble_quantize_rgba32_bytes(bytearray(pixels), truncate)
+
+    raw = not isinstance(pixels, numpy.ndarray)
+    if raw:
+        if isinstance(pixels, memoryview):
+            pixels = numpy.asarray(pixels).view(numpy.uint8)  # python 2 frombuffer() can't take a memoryview
+        else:
+            pixels = numpy.frombuffer(pixels, dtype=numpy.uint8)
+        pixels = pixels.reshape(-1, 4)
+    if pixels.dtype != numpy.uint8 or pixels.shape[-1] != 4:
+        raise ValueError("Expected a uint8 buffer of rgba32 pixels")
+
+    if truncate:
+        lut = numpy.array([(v / 85) * 85 for v in xrange(256)], dtype=numpy.uint8)
+    else:
+        lut = numpy.array([((v + 42) / 85) * 85 for v in xrange(256)], dtype=numpy.uint8)
+    quantized = lut[pixels]
+    # clear transparent pixels, as the per pixel routines do
+    quantized[quantized[..., 3] == 0] = 0
+
+    bits = quantized >> 6
+    argb8 = (bits[..., 3] << 6) | (bits[..., 0] << 4) | (bits[..., 1] << 2) | bits[..., 2]
+    if raw:
+        return quantized.tostring(), argb8.tostring()
+    return quantized, argb8
+
+
+def _pebble_quantize_rgba32_bytes(pixels, truncate):
+    convert = pebble_truncate_color_to_pebble_palette if truncate else pebble_nearest_color_to_pebble_palette
+    quantized = bytearray(len(pixels))
+    argb8 = bytearray(len(pixels) / 4)
+    for i in xrange(0, len(pixels) - 3, 4):
+        color = convert(*pixels[i:i + 4])
+        quantized[i:i + 4] = bytearray(color)
+        argb8[i / 4] = rgba32_triplet_to_argb8(*color)
+    return bytes(quantized), bytes(argb8)
+
+
 # convert 32-bit color (r, g, b, a) to 32-bit RGBA word
 def rgba32_triplet_to_rgba32(r, g, b, a):
     return (((r & 0xFF) << 24) | ((g & 0xFF) << 16) | ((b & 0xFF) << 8) | (a & 0xFF))
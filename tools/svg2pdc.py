@@ -14,13 +14,31 @@ g, layer, path, rect, polyline, polygon, line, circle,
 '''
 
 import xml.etree.ElementTree as ET
-import svg.path
 import argparse
-from struct import pack
+from struct import Struct
+from array import array
 import os
 import glob
 import sys
 import re
+import multiprocessing
+import hashlib
+import imp
+import time
+import copy
+import json
+import threading
+import math
+import io
+import shutil
+from collections import deque
+from itertools import islice, izip
+from pebble_image_routines import pebble_nearest_color_to_pebble_palette, pebble_truncate_color_to_pebble_palette, \
+    rgba32_triplet_to_argb8, pebble_rgba32_to_argb8, \
+    pebble_rgba32_to_bw_argb8
+
+numpy = None  # imported on first use, see get_numpy
+_numpy_checked = False
 
 epsilon = sys.float_info.epsilon
 
@@ -31,8 +49,134 @@ DRAW_COMMAND_TYPE_PRECISE_PATH = 3
 
 COORDINATE_SHIFT_WARNING_THRESHOLD = 0.1
 
+# frames of a streamed sequence are handed to the workers in chunks, with a bounded number of chunks parsed ahead of
+# the frame being written
+FRAMES_PER_CHUNK = 8
+CHUNKS_AHEAD_PER_WORKER = 2
+
+VECTORIZE_MIN_POINTS = 32  # below this, numpy call overhead outweighs the per-point work
+
+DEFAULT_FLATTEN_TOLERANCE = 0.5  # maximum distance between a curve and its flattened path (pixels, 1/8 px if precise)
+FLATTEN_SAMPLES = 16             # points of the curve checked against each chord
+FLATTEN_SEARCH_STEPS = 16        # bisection steps used to find the longest chord within tolerance
+FLATTEN_MAX_POINTS = 256         # points emitted per curve at most, whatever the tolerance
+
+FILE_HEADER = Struct('<4sI')         # magic word, size
+IMAGE_HEADER = Struct('<BBhh')       # version, reserved, width, height
+SEQUENCE_HEADER = Struct('<BBhhHH')  # version, reserved, width, height, play count, number of frames
+FRAME_HEADER = Struct('<H')          # duration
+COMMAND_LIST_HEADER = Struct('<H')   # number of commands
+PATH_HEADER = Struct('<BBBBBBBH')    # type, reserved, stroke color, stroke width, fill color, open, unused, num points
+CIRCLE_HEADER = Struct('<BBBBBHH')   # type, reserved, stroke color, stroke width, fill color, radius, num points
+POINT = Struct('<hh')
+
+DIRTY_RECTS_MAGIC = 'PDCD'
+DIRTY_RECTS_HEADER = Struct('<H')  # number of frames
+DIRTY_RECT = Struct('<hhhh')       # x, y, width, height (a GRect)
+DIRTY_RECT_MARGIN = 1              # pixels around the changed commands, for antialiased edges
+
 xmlns = '{http://www.w3.org/2000/svg}'
 
+IDENTITY_TRANSFORM = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)  # affine matrices are (a, b, c, d, e, f) as in SVG's matrix()
+TRANSFORM_RE = re.compile(r'([A-Za-z]+)\s*\(([^)]*)\)')
+
+
+class ConversionStats(object):
+    """
+    Collects the wall time per stage, element and point counters and the warnings of converting one path. While a
+    collector is active (see active_stats) warnings are buffered in it instead of being printed.
+    Stage timings are inclusive: traversal includes path_parse and coordinate_conversion.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.timings = {}
+        self.counters = {}
+        self.elements = {}
+        self.warnings = []
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_element(self, tag):
+        self.elements[tag] = self.elements.get(tag, 0) + 1
+
+    def merge(self, other):
+        for stage, seconds in other.timings.items():
+            self.add_time(stage, seconds)
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for tag, n in other.elements.items():
+            self.elements[tag] = self.elements.get(tag, 0) + n
+        self.warnings += other.warnings
+
+    def as_dict(self):
+        return {'path': self.path, 'timings': self.timings, 'counters': self.counters, 'elements': self.elements,
+                'warnings': self.warnings}
+
+
+_active = threading.local()
+
+
+def get_active_stats():
+    return getattr(_active, 'stats', None)
+
+
+class active_stats(object):
+    """Context manager making stats the collector of the current thread"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = get_active_stats()
+        _active.stats = self.stats
+        return self.stats
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active.stats = self.previous
+
+
+class stage_timer(object):
+    """Context manager adding the wall time of a block to a stage of the active collector, if there is one"""
+    __slots__ = ('stage', 'stats', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.stats = get_active_stats()
+
+    def __enter__(self):
+        if self.stats is not None:
+            self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.stats is not None:
+            self.stats.add_time(self.stage, time.time() - self.start)
+
+
+def get_warning_count():
+    # number of warnings so far in the current thread, printed or buffered
+    return getattr(_active, 'warning_count', 0)
+
+
+def warn(message):
+    _active.warning_count = get_warning_count() + 1
+    stats = get_active_stats()
+    if stats is not None:
+        stats.warnings.append(message)
+    else:
+        print message
+
+
+def count(name, n=1):
+    stats = get_active_stats()
+    if stats is not None:
+        stats.count(name, n)
+
 
 def sum_points(p1, p2):
     return p1[0] + p2[0], p1[1] + p2[1]
@@ -51,6 +195,43 @@ def scale_point(p, factor):
     return p[0] * factor, p[1] * factor
 
 
+def translation(tx, ty):
+    return 1.0, 0.0, 0.0, 1.0, float(tx), float(ty)
+
+
+def as_transform(transform):
+    # a plain (x, y) translation, as returned by get_info, is accepted wherever a transform is
+    if len(transform) == 2:
+        return translation(transform[0], transform[1])
+    return transform
+
+
+def multiply_transforms(m1, m2):
+    # the transform applying m2 first, then m1
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+            a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+
+def is_translation(transform):
+    return transform[:4] == (1.0, 0.0, 0.0, 1.0)
+
+
+def transform_point(p, transform):
+    a, b, c, d, e, f = transform
+    if is_translation(transform):
+        return p[0] + e, p[1] + f
+    return a * p[0] + c * p[1] + e, b * p[0] + d * p[1] + f
+
+
+def transform_scale(transform):
+    # uniform scale factor of a transform, used for lengths such as radii and stroke widths
+    a, b, c, d, _, _ = as_transform(transform)
+    return math.sqrt(abs(a * d - b * c))
+
+
 def find_nearest_valid_point(p):
     return (round(p[0] * 2.0) / 2.0), (round(p[1] * 2.0) / 2.0)
 
@@ -70,8 +251,8 @@ def convert_to_pebble_coordinates(point, precise=False):
 
     valid = compare_points(point, nearest)
     if not valid:
-        print "Invalid point: ({}, {}). Closest supported coordinate: ({}, {})".format(point[0], point[1],
-                                                                                       nearest[0], nearest[1])
+        warn("Invalid point: ({}, {}). Closest supported coordinate: ({}, {})".format(point[0], point[1],
+                                                                                      nearest[0], nearest[1]))
 
     translated = sum_points(point, (-0.5, -0.5))   # translate point by (-0.5, -0.5)
     if precise:
@@ -85,10 +266,94 @@ def compare_points(p1, p2):
     return p1[0] == p2[0] and p1[1] == p2[1]
 
 
+def get_numpy():
+    # numpy takes longer to import than converting an icon, so it's only imported once a point list is long enough to
+    # be vectorized. Returns None if it isn't installed
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+def _round_half_away_from_zero(values):
+    # numpy rounds halves to even, python 2 round() rounds them away from zero (and keeps the sign of zero)
+    floor = numpy.floor(values)
+    frac = values - floor
+    rounded = floor + ((frac > 0.5) | ((frac == 0.5) & (values >= 0)))
+    return numpy.copysign(rounded, values)
+
+
+def _convert_points_numpy(points, transform, precise):
+    coords = numpy.array(points, dtype=numpy.float64).reshape(-1, 2)
+    a, b, c, d, e, f = transform
+    if is_translation(transform):
+        coords += (e, f)
+    else:
+        coords = coords.dot(numpy.array([[a, b], [c, d]])) + (e, f)
+    scaled = coords * (8.0 if precise else 2.0)
+    invalid = numpy.flatnonzero((numpy.floor(scaled) != scaled).any(axis=1)).tolist()
+
+    translated = coords + (-0.5)
+    if precise:
+        translated *= 8
+    rounded = _round_half_away_from_zero(translated + epsilon)
+    return [tuple(p) for p in rounded.tolist()], invalid
+
+
+def _convert_points_python(points, transform, precise):
+    scale = 8.0 if precise else 2.0
+    converted = []
+    invalid = []
+    for i, p in enumerate(points):
+        x, y = transform_point(p, transform)
+        if round(x * scale) / scale != x or round(y * scale) / scale != y:
+            invalid.append(i)
+        x, y = x + (-0.5), y + (-0.5)
+        if precise:
+            x, y = x * 8, y * 8
+        converted.append((round(x + epsilon), round(y + epsilon)))
+    return converted, invalid
+
+
+def convert_points_to_pebble_coordinates(points, transform=(0, 0), precise=False, generated=()):
+    """
+    Batched equivalent of calling convert_to_pebble_coordinates on every transformed point in a list. transform is
+    an affine matrix or an (x, y) translation, applied to the whole point list at once.
+    generated are the indices of points created by the tool (e.g. by flattening curves), they are snapped to the
+    nearest valid coordinate after the transform instead of being reported.
+    Returns the converted points and the indices of the points that weren't on a valid coordinate.
+    """
+    transform = as_transform(transform)
+    if generated:
+        snap = find_nearest_valid_precise_point if precise else find_nearest_valid_point
+        points = [transform_point(p, transform) for p in points]
+        for i in generated:
+            points[i] = snap(points[i])
+        transform = IDENTITY_TRANSFORM
+    with stage_timer('coordinate_conversion'):
+        if len(points) >= VECTORIZE_MIN_POINTS and get_numpy() is not None:
+            converted, invalid = _convert_points_numpy(points, transform, precise)
+        else:
+            converted, invalid = _convert_points_python(points, transform, precise)
+    if invalid:
+        count('invalid_points', len(invalid))
+
+    for i in invalid:
+        point = transform_point(points[i], transform)
+        nearest = find_nearest_valid_precise_point(point) if precise else find_nearest_valid_point(point)
+        warn("Invalid point: ({}, {}). Closest supported coordinate: ({}, {})".format(point[0], point[1],
+                                                                                      nearest[0], nearest[1]))
+    return converted, invalid
+
+
 class InvalidPointException(Exception):
     pass
 
-class Command():
+class Command(object):
     '''
     Draw command serialized structure:
     | Bytes | Field
@@ -115,52 +380,87 @@ class Command():
     | 2     | y
     '''
 
-    def __init__(self, points, translate, stroke_width=0, stroke_color=0, fill_color=0, precise=False,
-                 raise_error=False):
-        for i in range(len(points)):
-            points[i], valid = convert_to_pebble_coordinates(sum_points(points[i], translate), precise)
-            if not valid and raise_error:
-                raise InvalidPointException("Invalid point in command")
+    # commands are kept alive for every frame of a sequence, so they avoid a per-instance __dict__ and store their
+    # points as packed int16 x/y pairs, which is also the serialized point format
+    __slots__ = ('coords', 'stroke_width', 'stroke_color', 'fill_color')
+
+    def __init__(self, points, transform, stroke_width=0, stroke_color=0, fill_color=0, precise=False,
+                 raise_error=False, generated=()):
+        points, invalid = convert_points_to_pebble_coordinates(points, transform, precise, generated)
+        if invalid and raise_error:
+            raise InvalidPointException("Invalid point in command")
 
         self.points = points
         self.stroke_width = stroke_width
         self.stroke_color = stroke_color
         self.fill_color = fill_color
 
-    def serialize_common(self):
-        return pack('<BBBB',
-                    0,                  #reserved byte
-                    self.stroke_color,
-                    self.stroke_width,
-                    self.fill_color)
+    @property
+    def points(self):
+        return zip(self.coords[0::2], self.coords[1::2])
+
+    @points.setter
+    def points(self, points):
+        self.coords = array('h', [int(v) for p in points for v in p])
+
+    @property
+    def num_points(self):
+        return len(self.coords) // 2
+
+    def __getstate__(self):
+        # slotted objects have no __dict__ to pickle (needed to send commands between worker processes)
+        return dict((name, getattr(self, name)) for cls in type(self).__mro__
+                    for name in getattr(cls, '__slots__', ()))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
-    def serialize_points(self):
-        s = pack('H', len(self.points))  # number of points (16-bit)
-        for p in self.points:
-            s += pack('<hh',
-                      int(p[0]),        # x (16-bit)
-                      int(p[1]))        # y (16-bit)
-        return s
+    def coords_bytes(self):
+        if sys.byteorder == 'little':
+            return self.coords.tostring()
+        coords = array('h', self.coords)
+        coords.byteswap()
+        return coords.tostring()
+
+    def pack_points_into(self, buf, offset):
+        end = offset + self.num_points * POINT.size
+        buf[offset:end] = self.coords_bytes()
+        return end
+
+    def serialize(self):
+        buf = bytearray(self.serialized_size())
+        self.pack_into(buf, 0)
+        return bytes(buf)
 
 
 class PathCommand(Command):
-    def __init__(self, points, path_open, translate, stroke_width=0, stroke_color=0, fill_color=0, precise=False,
-                 raise_error=False):
+    __slots__ = ('open', 'type')
+
+    def __init__(self, points, path_open, transform, stroke_width=0, stroke_color=0, fill_color=0, precise=False,
+                 raise_error=False, generated=()):
         self.open = path_open
         self.type = DRAW_COMMAND_TYPE_PATH if not precise else DRAW_COMMAND_TYPE_PRECISE_PATH
-        Command.__init__(self, points, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
-
-    def serialize(self):
-        s = pack('B', self.type)   # command type
-        s += self.serialize_common()
-        s += pack('<BB',
-                  int(self.open),   # open path boolean
-                  0)                # unused byte in path
-        s += self.serialize_points()
-        return s
+        Command.__init__(self, points, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+                         generated)
+
+    def serialized_size(self):
+        return PATH_HEADER.size + self.num_points * POINT.size
+
+    def pack_into(self, buf, offset):
+        PATH_HEADER.pack_into(buf, offset,
+                              self.type,          # command type
+                              0,                  # reserved byte
+                              self.stroke_color,
+                              self.stroke_width,
+                              self.fill_color,
+                              int(self.open),     # open path boolean
+                              0,                  # unused byte in path
+                              self.num_points)    # number of points (16-bit)
+        return self.pack_points_into(buf, offset + PATH_HEADER.size)
 
     def __str__(self):
-        points = self.points[:]
+        points = [(float(x), float(y)) for x, y in self.points]
         if self.type == DRAW_COMMAND_TYPE_PRECISE_PATH:
             type = 'P'
             for i in range(len(points)):
@@ -176,23 +476,32 @@ class PathCommand(Command):
 
 
 class CircleCommand(Command):
-    def __init__(self, center, radius, translate, stroke_width=0, stroke_color=0, fill_color=0):
+    __slots__ = ('radius',)
+
+    def __init__(self, center, radius, transform, stroke_width=0, stroke_color=0, fill_color=0):
         points = [(center[0], center[1])]
-        Command.__init__(self, points, translate, stroke_width, stroke_color, fill_color)
+        Command.__init__(self, points, transform, stroke_width, stroke_color, fill_color)
         self.radius = radius
 
-    def serialize(self):
-        s = pack('B', DRAW_COMMAND_TYPE_CIRCLE)  # command type
-        s += self.serialize_common()
-        s += pack('H', self.radius)  # circle radius (16-bit)
-        s += self.serialize_points()
-        return s
+    def serialized_size(self):
+        return CIRCLE_HEADER.size + self.num_points * POINT.size
+
+    def pack_into(self, buf, offset):
+        CIRCLE_HEADER.pack_into(buf, offset,
+                                DRAW_COMMAND_TYPE_CIRCLE,  # command type
+                                0,                         # reserved byte
+                                self.stroke_color,
+                                self.stroke_width,
+                                self.fill_color,
+                                self.radius,               # circle radius (16-bit)
+                                self.num_points)           # number of points (16-bit)
+        return self.pack_points_into(buf, offset + CIRCLE_HEADER.size)
 
     def __str__(self):
         return "Circle: [fill color:{}; stroke color:{}; stroke width:{}] {} {}".format(self.fill_color,
                                                                                         self.stroke_color,
                                                                                         self.stroke_width,
-                                                                                        self.points[0],
+                                                                                        tuple(map(float, self.points[0])),
                                                                                         self.radius)
 
 
@@ -208,28 +517,88 @@ def get_viewbox(root):
         return (0, 0), (0, 0)
 
 
-def get_translate(group):
-    trans = group.get('translate')
-    if trans is not None:
-        pos = trans.find('translate')
-        if pos < 0:
-            print "No translation in translate"
-            return 0, 0
+def _transform_matrix(name, values):
+    # matrix of a single transform function, None if it isn't supported
+    n = len(values)
+    if name == 'matrix' and n == 6:
+        return tuple(values)
+    if name == 'translate' and n in (1, 2):
+        return translation(values[0], values[1] if n == 2 else 0.0)
+    if name == 'scale' and n in (1, 2):
+        return values[0], 0.0, 0.0, values[1] if n == 2 else values[0], 0.0, 0.0
+    if name == 'rotate' and n in (1, 3):
+        angle = math.radians(values[0])
+        rotation = (math.cos(angle), math.sin(angle), -math.sin(angle), math.cos(angle), 0.0, 0.0)
+        if n == 1:
+            return rotation
+        cx, cy = values[1], values[2]
+        return multiply_transforms(multiply_transforms(translation(cx, cy), rotation), translation(-cx, -cy))
+    if name == 'skewX' and n == 1:
+        return 1.0, 0.0, math.tan(math.radians(values[0])), 1.0, 0.0, 0.0
+    if name == 'skewY' and n == 1:
+        return 1.0, math.tan(math.radians(values[0])), 0.0, 1.0, 0.0, 0.0
+    return None
+
+
+# the memo caches below live as long as the process, which can be long in --watch mode, so they are bounded: once
+# MEMO_CACHE_SIZE entries are reached a cache starts over
+MEMO_CACHE_SIZE = 4096
+
+
+def memoize(cache, key, value):
+    if len(cache) >= MEMO_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
 
-        import ast
+
+_transform_cache = {}
+
+
+def parse_transform(transform):
+    """
+    Compiles a transform attribute such as 'translate(10 5) rotate(45)' into a single affine matrix.
+    Exports repeat the same few transforms, so compiled transforms are memoized.
+    """
+    try:
+        return _transform_cache[transform]
+    except KeyError:
+        pass
+
+    matrix = IDENTITY_TRANSFORM
+    supported = True
+    for name, args in TRANSFORM_RE.findall(transform):
         try:
-            return ast.literal_eval(trans[pos + len('translate'):])
-        except (ValueError, TypeError):
-            print "translate contains unsupported elements in addition to translation"
+            values = [float(v) for v in re.split(r'[\s,]+', args.strip()) if v]
+        except ValueError:
+            values = []
+        function_matrix = _transform_matrix(name, values)
+        if function_matrix is None:
+            warn("Unsupported transform: {}({})".format(name, args))
+            supported = False
+            continue
+        matrix = multiply_transforms(matrix, function_matrix)  # the rightmost function is applied first
 
-    return 0, 0
+    # transforms with unsupported functions aren't memoized, so that every element using them gets the warning
+    return memoize(_transform_cache, transform, matrix) if supported else matrix
 
 
-def convert_color(rgb, a, truncate=True):
-    from pebble_image_routines import pebble_nearest_color_to_pebble_palette, pebble_truncate_color_to_pebble_palette, \
-        rgba32_triplet_to_argb8
+def get_transform(element, parent_transform):
+    # composes the transform of an element with the one of its enclosing groups
+    transform = parent_transform
+    for attribute in ('transform', 'translate'):  # some exporters write a non-standard translate attribute
+        value = element.get(attribute)
+        if value:
+            transform = multiply_transforms(transform, parse_transform(value))
+    return transform
+
 
+def convert_color(rgb, a, truncate=True):
     r, g, b = (rgb >> 16) & 0xFF, (rgb >> 8) & 0xFF, rgb & 0xFF
+    if 0 <= a <= 0xFF:
+        return pebble_rgba32_to_argb8(r, g, b, a, truncate)
+
+    # opacities outside of [0, 1] can't use the lookup tables
     if truncate:
         (r, g, b, a) = pebble_truncate_color_to_pebble_palette(r, g, b, a)
     else:
@@ -238,14 +607,169 @@ def convert_color(rgb, a, truncate=True):
     return rgba32_triplet_to_argb8(r, g, b, a)
 
 
+_color_cache = {}
+
+
 def parse_color(color, opacity, truncate):
+    # exports repeat the same few colors for every element, so resolved colors are memoized
+    # truncate None defers the palette mapping: the color is kept as an (rgb, alpha) pair, see resolve_color
+    key = (color, opacity, truncate)
+    try:
+        return _color_cache[key]
+    except KeyError:
+        pass
+
     if color is None or color[0] != '#':
-        return 0
+        argb8 = 0
+    else:
+        rgb = int(color[1:7], 16)
+        a = int(opacity * 255)
+        argb8 = (rgb, a) if truncate is None else convert_color(rgb, a, truncate)
+
+    return memoize(_color_cache, key, argb8)
+
+
+VARIANTS = ('bw', 'color')  # resource tags picked by the SDK for black and white and for color platforms
+
+_variant_color_cache = {}
+
+
+def resolve_color(color, variant):
+    # maps a deferred (rgb, alpha) color to the ARGB8 color of a variant, resolved colors are returned as is
+    if variant is None or not isinstance(color, tuple):
+        return color
+    key = (color, variant)
+    try:
+        return _variant_color_cache[key]
+    except KeyError:
+        pass
+
+    rgb, a = color
+    if variant == 'bw':
+        argb8 = pebble_rgba32_to_bw_argb8((rgb >> 16) & 0xFF, (rgb >> 8) & 0xFF, rgb & 0xFF, a)
+    else:
+        argb8 = convert_color(rgb, a, truncate=True)
+
+    return memoize(_variant_color_cache, key, argb8)
+
+
+def resolve_commands(commands, variant):
+    """
+    Resolves the colors of a platform neutral command list (parsed with truncate_color=None) for a variant. Commands
+    whose colors both end up transparent are dropped, like create_command does.
+    """
+    if variant is None:
+        return commands
+    resolved = []
+    for c in commands:
+        c = copy.copy(c)
+        c.stroke_color = resolve_color(c.stroke_color, variant)
+        c.fill_color = resolve_color(c.fill_color, variant)
+        if c.stroke_color == 0 and c.fill_color == 0:
+            continue
+        if c.stroke_color == 0:
+            c.stroke_width = 0
+        resolved.append(c)
+    return resolved
+
 
-    rgb = int(color[1:7], 16)
-    a = int(opacity * 255)
+def resolve_frames(frames, variant):
+    return [resolve_commands(f, variant) for f in frames]
 
-    return convert_color(rgb, a, truncate)
+
+def get_variant_path(path, variant):
+    # resources/icon.pdc -> resources/icon~bw.pdc
+    if variant is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}~{}{}'.format(root, variant, ext)
+
+
+STYLE_PROPERTIES = ('display', 'opacity', 'fill', 'fill-opacity', 'stroke', 'stroke-opacity', 'stroke-width')
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_RULE_RE = re.compile(r'([^{}]+)\{([^{}]*)\}')
+CSS_SELECTOR_RE = re.compile(r'^([A-Za-z][\w-]*)?(?:\.([\w-]+))?$|^#([\w-]+)$')
+
+_style_cache = {}
+
+
+def parse_style(style):
+    # parses a 'fill:#FF0000;stroke-width:2' declaration list, exports repeat the same few so they're memoized
+    try:
+        return _style_cache[style]
+    except KeyError:
+        pass
+
+    declarations = {}
+    for item in style.split(';'):
+        name, sep, value = item.partition(':')
+        if sep and name.strip():
+            declarations[name.strip()] = value.strip()
+
+    return memoize(_style_cache, style, declarations)
+
+
+class StyleSheet(object):
+    """
+    The <style> rules of a document, indexed by id, class and tag once. Supports '#id', '.class', 'tag' and
+    'tag.class' selectors.
+    resolve() returns the style properties of an element following the cascade: presentation attributes, then
+    matching rules by specificity and order, then the inline style attribute.
+    """
+
+    def __init__(self, root=None):
+        self.rules = {}  # (kind, name) -> [(specificity, order, tag, declarations)]
+        self.num_rules = 0
+        self._resolved = {}
+        if root is not None:
+            for element in root.iter(xmlns + 'style'):
+                self.add_rules(element.text or '')
+
+    def add_rules(self, css):
+        for selectors, body in CSS_RULE_RE.findall(CSS_COMMENT_RE.sub('', css)):
+            declarations = parse_style(body)
+            for selector in selectors.split(','):
+                match = CSS_SELECTOR_RE.match(selector.strip())
+                if match is None:
+                    warn("Unsupported CSS selector: " + selector.strip())
+                    continue
+                tag, cls, element_id = match.groups()
+                if element_id:
+                    key = ('id', element_id)
+                elif cls:
+                    key = ('class', cls)
+                else:
+                    key = ('tag', tag)
+                # (ids, classes, tags), compared in that order like CSS does
+                specificity = (int(bool(element_id)), int(bool(cls)), int(bool(tag)))
+                self.rules.setdefault(key, []).append((specificity, self.num_rules, tag, declarations))
+                self.num_rules += 1
+
+    def resolve(self, element):
+        tag = element.tag[len(xmlns):]
+        classes = element.get('class')
+        element_id = element.get('id') if self.rules else None
+        inline = element.get('style')
+        attributes = tuple(element.get(name) for name in STYLE_PROPERTIES)
+        key = (tag, classes, element_id, inline, attributes)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+
+        properties = dict((name, value) for name, value in zip(STYLE_PROPERTIES, attributes) if value is not None)
+        if self.rules:
+            matches = list(self.rules.get(('tag', tag), []))
+            matches += self.rules.get(('id', element_id), [])
+            for cls in (classes or '').split():
+                matches += [r for r in self.rules.get(('class', cls), []) if r[2] is None or r[2] == tag]
+            for _, _, _, declarations in sorted(matches, key=lambda r: (r[0], r[1])):
+                properties.update(declarations)
+        if inline:
+            properties.update(parse_style(inline))
+
+        self._resolved[key] = properties
+        return properties
 
 
 def calc_opacity(a1, a2):
@@ -272,31 +796,100 @@ def get_points_from_str(point_str):
     return points
 
 
-def parse_path(element, translate, stroke_width, stroke_color, fill_color, precise, raise_error):
-    import svg.path
+def _distance_to_segment(p, a, b):
+    # points are complex numbers, as used by svg.path
+    ab = b - a
+    if ab == 0:
+        return abs(p - a)
+    t = min(max(((p - a) * ab.conjugate()).real / (abs(ab) ** 2), 0.0), 1.0)
+    return abs(p - (a + t * ab))
+
+
+def _chord_fits(segment, t0, t1, tolerance):
+    a = segment.point(t0)
+    b = segment.point(t1)
+    for i in range(1, FLATTEN_SAMPLES):
+        if _distance_to_segment(segment.point(t0 + (t1 - t0) * i / FLATTEN_SAMPLES), a, b) > tolerance:
+            return False
+    return True
+
+
+def flatten_segment(segment, tolerance):
+    """
+    Approximates a curved svg.path segment with straight lines that stay within tolerance of the curve. Every chord
+    is made as long as possible, so a close to minimal number of points is emitted. Returns the points following the
+    start of the segment, ending with its end point.
+    Chords span at least 1 / FLATTEN_MAX_POINTS of the curve, which bounds the number of points of tolerances too
+    small for the curve. The bound also doesn't account for snapping the points to valid coordinates afterwards, which
+    moves them by up to half a coordinate step on each axis (see parse_path).
+    """
+    if tolerance <= 0:
+        raise ValueError("Flattening tolerance must be positive, got {}".format(tolerance))
+    points = []
+    t0 = 0.0
+    while t0 < 1.0:
+        if _chord_fits(segment, t0, 1.0, tolerance):
+            t1 = 1.0
+        else:
+            lo, hi = t0, 1.0
+            for _ in range(FLATTEN_SEARCH_STEPS):
+                mid = (lo + hi) / 2
+                if _chord_fits(segment, t0, mid, tolerance):
+                    lo = mid
+                else:
+                    hi = mid
+            t1 = min(max(lo, t0 + 1.0 / FLATTEN_MAX_POINTS), 1.0)
+        p = segment.end if t1 == 1.0 else segment.point(t1)
+        points.append((p.real, p.imag))
+        t0 = t1
+    return points
+
+
+def parse_path(element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+               tolerance=DEFAULT_FLATTEN_TOLERANCE):
+    import svg.path  # only needed to parse svg files, tools reading .pdc files don't depend on it
     d = element.get('d')
     if d is not None:
-        path = svg.path.parse_path(d)
-        points = [(lambda l: (l.real, l.imag))(line.start) for line in path]
-        if not points:
-            print "No points in parsed path"
+        with stage_timer('path_parse'):
+            path = svg.path.parse_path(d)
+        if not len(path):
+            warn("No points in parsed path")
             return None
 
-        path_open = path[-1].end != path[0].start
+        # curves are flattened before they're transformed, tolerance is given in pebble pixels (1/8 pixels for
+        # precise paths)
+        curve_tolerance = (tolerance / 8.0 if precise else tolerance) / (transform_scale(transform) or 1.0)
+        generated = []  # indices of the points created by flattening
+        with stage_timer('path_parse'):
+            points = [(path[0].start.real, path[0].start.imag)]
+            for segment in path:
+                start = (segment.start.real, segment.start.imag)
+                if not compare_points(points[-1], start):
+                    points.append(start)  # start of a subpath (moveto)
+                if isinstance(segment, (svg.path.CubicBezier, svg.path.QuadraticBezier, svg.path.Arc)):
+                    flattened = flatten_segment(segment, curve_tolerance)
+                    generated += range(len(points), len(points) + len(flattened) - 1)
+                    points += flattened
+                elif segment.end != segment.start or isinstance(segment, svg.path.Line):
+                    points.append((segment.end.real, segment.end.imag))
 
-        if path_open:
-            points.append((path[-1].end.real, path[-1].end.imag))
+        path_open = path[-1].end != path[0].start
 
         # remove last point if it matches first point
         if compare_points(points[0], points[-1]):
             points = points[0:-1]
+            generated = [i for i in generated if i < len(points)]
 
-        return PathCommand(points, path_open, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
+        # points created by flattening are snapped to valid coordinates once transformed, they aren't the designer's
+        # mistake. This adds up to half a coordinate step per axis to the distance from the curve
+        return PathCommand(points, path_open, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+                           generated)
     else:
-        print "Path element does not have path attribute"
+        warn("Path element does not have path attribute")
 
 
-def parse_circle(element, translate, stroke_width, stroke_color, fill_color, precise, raise_error):
+def parse_circle(element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+                 tolerance=DEFAULT_FLATTEN_TOLERANCE):
     cx = element.get('cx')      # center x-value
     cy = element.get('cy')      # center y-value
     radius = element.get('r')   # radius
@@ -305,41 +898,51 @@ def parse_circle(element, translate, stroke_width, stroke_color, fill_color, pre
     if cx is not None and cy is not None and radius is not None:
         try:
             center = (float(cx), float(cy))
-            radius = float(radius)
-            return CircleCommand(center, radius, translate, stroke_width, stroke_color, fill_color)
+            radius = float(radius) * transform_scale(transform)
+            a, b, c, d, _, _ = as_transform(transform)
+            # circles stay circles under rotations, reflections and uniform scales: both axes keep the same length
+            # and stay orthogonal (compared relative to the scale, which products of transforms round)
+            tolerance = 1e-9 * (a * a + b * b + c * c + d * d)
+            if abs(a * a + b * b - c * c - d * d) > tolerance or abs(a * c + b * d) > tolerance:
+                warn("Circle is transformed into an ellipse, drawing it as a circle")
+            return CircleCommand(center, radius, transform, stroke_width, stroke_color, fill_color)
         except ValueError:
-            print "Unrecognized circle format"
+            warn("Unrecognized circle format")
     else:
-        print "Unrecognized circle format"
+        warn("Unrecognized circle format")
 
 
-def parse_polyline(element, translate, stroke_width, stroke_color, fill_color, precise, raise_error):
+def parse_polyline(element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+                   tolerance=DEFAULT_FLATTEN_TOLERANCE):
     points = get_points_from_str(element.get('points'))
     if not points:
         return None
 
-    return PathCommand(points, True, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
+    return PathCommand(points, True, transform, stroke_width, stroke_color, fill_color, precise, raise_error)
 
 
-def parse_polygon(element, translate, stroke_width, stroke_color, fill_color, precise, raise_error):
+def parse_polygon(element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+                  tolerance=DEFAULT_FLATTEN_TOLERANCE):
     points = get_points_from_str(element.get('points'))
     if not points:
         return None
 
-    return PathCommand(points, False, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
+    return PathCommand(points, False, transform, stroke_width, stroke_color, fill_color, precise, raise_error)
 
 
-def parse_line(element, translate, stroke_width, stroke_color, fill_color, precise, raise_error):
+def parse_line(element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+               tolerance=DEFAULT_FLATTEN_TOLERANCE):
     try:
         points = [(float(element.get('x1')), float(element.get('y1'))),
                   (float(element.get('x2')), float(element.get('y2')))]
     except (TypeError, ValueError):
         return None
 
-    return PathCommand(points, True, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
+    return PathCommand(points, True, transform, stroke_width, stroke_color, fill_color, precise, raise_error)
 
 
-def parse_rect(element, translate, stroke_width, stroke_color, fill_color, precise, raise_error):
+def parse_rect(element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+               tolerance=DEFAULT_FLATTEN_TOLERANCE):
     try:
         origin = (float(element.get('x')), float(element.get('y')))
         width = float(element.get('width'))
@@ -349,7 +952,7 @@ def parse_rect(element, translate, stroke_width, stroke_color, fill_color, preci
     points = [origin, sum_points(origin, (width, 0)), sum_points(origin, (width, height)),
               sum_points(origin, (0, height))]
 
-    return PathCommand(points, False, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
+    return PathCommand(points, False, transform, stroke_width, stroke_color, fill_color, precise, raise_error)
 
 svg_element_parser = {'path': parse_path,
                       'circle': parse_circle,
@@ -358,19 +961,51 @@ svg_element_parser = {'path': parse_path,
                       'line': parse_line,
                       'rect': parse_rect}
 
-# assume only depth 1 for groups for the moment, collapse groups on inkscape
-group_opacity = None
-group_fill = None
-group_fill_opacity = None
-group_stroke = None
-group_stroke_opacity = None
-group_stroke_width = None
+class GroupStyle(object):
+    """
+    Presentation attributes inherited from the enclosing groups. Every group derives a new style from its parent's
+    instead of sharing module state, so conversions are re-entrant and nested groups inherit properly.
+    """
+    __slots__ = ('opacity', 'fill', 'fill_opacity', 'stroke', 'stroke_opacity', 'stroke_width')
+
+    def __init__(self, opacity=None, fill=None, fill_opacity=None, stroke=None, stroke_opacity=None,
+                 stroke_width=None):
+        self.opacity = opacity
+        self.fill = fill
+        self.fill_opacity = fill_opacity
+        self.stroke = stroke
+        self.stroke_opacity = stroke_opacity
+        self.stroke_width = stroke_width
 
-def create_command(translate, element, precise=False, raise_error=False, truncate_color=True):
-    style = element.get('style')
-    attributes = element
-    if style:
-      attributes = dict(item.split(":") for item in style.split(";") if item)
+    def inherit(self, group):
+        # empty attributes count as unset, but a value of 0 (e.g. an opacity compounded to 0.0) is kept
+        def get(name, inherited):
+            value = group.get(name) or None
+            return value if value is not None else inherited
+
+        opacity = group.get('opacity') or None
+        if opacity is not None and self.opacity is not None:
+            opacity = calc_opacity(opacity, self.opacity)  # group opacities compound
+        stroke_width = group.get('stroke-width') or None
+        #fix stroke-width for '1px' to be int 1
+        if stroke_width is not None:
+            stroke_width = int(float(filter(lambda x: x in '0123456789.', stroke_width)))
+            stroke_width = stroke_width if stroke_width >= 1 else 1
+        return GroupStyle(opacity if opacity is not None else self.opacity,
+                          get('fill', self.fill),
+                          get('fill-opacity', self.fill_opacity),
+                          get('stroke', self.stroke),
+                          get('stroke-opacity', self.stroke_opacity),
+                          stroke_width if stroke_width is not None else self.stroke_width)
+
+
+def create_command(transform, element, precise=False, raise_error=False, truncate_color=True, style=None,
+                   tolerance=DEFAULT_FLATTEN_TOLERANCE, stylesheet=None):
+    if style is None:
+        style = GroupStyle()
+    if stylesheet is None:
+        stylesheet = StyleSheet()
+    attributes = stylesheet.resolve(element)
 
     opacity = attributes.get('opacity')
     stroke = attributes.get('stroke')
@@ -378,12 +1013,14 @@ def create_command(translate, element, precise=False, raise_error=False, truncat
     fill = attributes.get('fill')
     fill_opacity = attributes.get('fill-opacity')
 
-    # if attribute wasn't set, use group attribute
-    opacity = opacity if opacity else group_opacity
-    stroke = stroke if stroke else group_stroke
-    stroke_opacity = stroke_opacity if stroke_opacity else group_stroke_opacity
-    fill = fill if fill else group_fill
-    fill_opacity = fill_opacity if fill_opacity else group_fill_opacity
+    # if attribute wasn't set, use group attribute. The element's opacity applies on top of the groups' opacity
+    if opacity and style.opacity is not None:
+        opacity = calc_opacity(opacity, style.opacity)
+    opacity = opacity if opacity else style.opacity
+    stroke = stroke if stroke else style.stroke
+    stroke_opacity = stroke_opacity if stroke_opacity else style.stroke_opacity
+    fill = fill if fill else style.fill
+    fill_opacity = fill_opacity if fill_opacity else style.fill_opacity
 
     stroke_color = parse_color(stroke, calc_opacity(stroke_opacity, opacity), truncate_color)
     fill_color = parse_color(fill, calc_opacity(fill_opacity, opacity), truncate_color)
@@ -391,8 +1028,8 @@ def create_command(translate, element, precise=False, raise_error=False, truncat
     try:
         stroke_width = int(float(attributes.get('stroke-width')))
     except TypeError:
-        #if value not set use global value or default to 1
-        stroke_width = group_stroke_width if group_stroke_width else 1
+        #if value not set use group value or default to 1
+        stroke_width = style.stroke_width if style.stroke_width else 1
     except ValueError:
         #wrong format
         stroke_width = 0
@@ -400,6 +1037,11 @@ def create_command(translate, element, precise=False, raise_error=False, truncat
     if stroke_color == 0 and fill_color == 0:
         return None
 
+    # strokes scale along with the shape
+    scale = transform_scale(transform)
+    if scale != 1.0 and stroke_width > 0:
+        stroke_width = max(int(round(stroke_width * scale)), 1)
+
     if stroke_color == 0:
         stroke_width = 0
     elif stroke_width == 0:
@@ -411,70 +1053,62 @@ def create_command(translate, element, precise=False, raise_error=False, truncat
         return None
 
     try:
-        return svg_element_parser[tag](element, translate, stroke_width, stroke_color, fill_color, precise, raise_error)
+        return svg_element_parser[tag](element, transform, stroke_width, stroke_color, fill_color, precise, raise_error,
+                                       tolerance)
     except KeyError:
         if tag != 'g' and tag != 'layer':
-            print "Unsupported element: " + tag
+            warn("Unsupported element: " + tag)
 
     return None
 
 
-def get_commands(translate, group, precise=False, raise_error=False, truncate_color=True):
-    global group_opacity
-    global group_fill
-    global group_fill_opacity
-    global group_stroke
-    global group_stroke_opacity
-    global group_stroke_width
+def get_commands(transform, group, precise=False, raise_error=False, truncate_color=True, style=None,
+                 tolerance=DEFAULT_FLATTEN_TOLERANCE, stylesheet=None):
+    '''
+    transform is the affine matrix (or (x, y) translation) of the group. The matrix of each nested group or element
+    is composed with it once, and applied to the whole point list of each command.
+    The style sheet of the document is indexed when the root is traversed and shared by the nested groups.
+    '''
+    if style is None:
+        style = GroupStyle()
+    if stylesheet is None:
+        stylesheet = StyleSheet(group)
+    transform = as_transform(transform)
+    stats = get_active_stats()
     commands = []
     error = False
 
     for child in group.getchildren():
-        # ignore elements that are marked display="none"
-        display = child.get('display')
-        if display is not None and display == 'none':
-            continue
         try:
             tag = child.tag[len(xmlns):]
-        except IndexError:
+        except (IndexError, TypeError):
             continue
+        # ignore elements that are marked display="none"
+        if stylesheet.resolve(child).get('display') == 'none':
+            continue
+        if stats is not None:
+            stats.count_element(tag)
 
         # traverse tree of nested layers or groups
         if tag == 'layer' or tag == 'g':
-            #get and set (or clear) group attributes
+            child_style = style
             if tag == 'g':
-              group_opacity = child.get('opacity') if child.get('opacity') else None
-              group_fill = child.get('fill') if child.get('fill') else None
-              group_fill_opacity = child.get('fill-opacity') if child.get('fill-opacity') else None
-              group_stroke = child.get('stroke') if child.get('stroke') else None
-              group_stroke_opacity = child.get('stroke-opacity') if child.get('stroke-opacity') else None
-              group_stroke_width = child.get('stroke-width') if child.get('stroke-width') else None
-              #fix stroke-width for '1px' to be int 1
-              if group_stroke_width:
-                group_stroke_width = int(float(filter( lambda x: x in '0123456789.', group_stroke_width)))
-                group_stroke_width = group_stroke_width if group_stroke_width >= 1 else 1
-              #handle the transform in the layer group
-              transform = child.get('transform', dict())
-              if 'translate' in transform:
-                translate_strs = re.search(r'(?:translate\()(.*),(.*)\)',transform).group(1,2)
-                translate = (translate[0] + float(translate_strs[0]), translate[1] + float(translate_strs[1]))
-            child_translate = get_translate(child)
-            translate = (translate[0] + child_translate[0], translate[1] + child_translate[1])
-            cmd_list, err = get_commands(translate, child, precise, raise_error, truncate_color)
+              #inherit group attributes from the enclosing groups
+              child_style = style.inherit(stylesheet.resolve(child))
+            cmd_list, err = get_commands(get_transform(child, transform), child, precise, raise_error, truncate_color,
+                                         child_style, tolerance, stylesheet)
             commands += cmd_list
             if err:
                 error = True
         else:
             try:
-                #handle the transform in the element
-                child_translate = translate
-                transform = child.get('transform')
-                if transform is not None and 'translate' in transform:
-                    translate_strs = re.search(r'(?:translate\()(.*),(.*)\)',transform).group(1,2)
-                    child_translate = (translate[0] + float(translate_strs[0]), translate[1] + float(translate_strs[1]))
-                c = create_command(child_translate, child, precise, raise_error, truncate_color)
+                c = create_command(get_transform(child, transform), child, precise, raise_error, truncate_color,
+                                   style, tolerance, stylesheet)
                 if c is not None:
                     commands.append(c)
+                    if stats is not None:
+                        stats.count('commands')
+                        stats.count('points', c.num_points)
             except InvalidPointException:
                 error = True
 
@@ -483,18 +1117,96 @@ def get_commands(translate, group, precise=False, raise_error=False, truncate_co
 
 def get_xml(filename):
     try:
-        root = ET.parse(filename).getroot()
+        with stage_timer('xml_parse'):
+            root = ET.parse(filename).getroot()
     except IOError:
         return None
     return root
 
 
-def serialize(commands):
-    output = pack('H', len(commands))   # number of commands in list
+def read_xml(filename):
+    # like get_xml, for callers that can't go on without the document
+    root = get_xml(filename)
+    if root is None:
+        raise IOError("Could not read {}".format(filename))
+    return root
+
+
+def is_redundant_point(p1, p2, p3):
+    # p2 can be dropped if it lies on the segment p1-p3 (exact integer math, so the outline is unchanged)
+    v1 = (p2[0] - p1[0], p2[1] - p1[1])
+    v2 = (p3[0] - p2[0], p3[1] - p2[1])
+    return v1[0] * v2[1] - v1[1] * v2[0] == 0 and v1[0] * v2[0] + v1[1] * v2[1] >= 0
+
+
+def remove_redundant_points(points, path_open):
+    optimized = []
+    for p in points:
+        if optimized and p == optimized[-1]:
+            continue  # consecutive duplicate
+        while len(optimized) >= 2 and is_redundant_point(optimized[-2], optimized[-1], p):
+            optimized.pop()
+        if not optimized or p != optimized[-1]:
+            optimized.append(p)
+
+    if not path_open:
+        # closed paths wrap around, so the first and last points are interior points as well
+        if len(optimized) > 1 and optimized[0] == optimized[-1]:
+            optimized.pop()
+        while len(optimized) > 3 and is_redundant_point(optimized[-2], optimized[-1], optimized[0]):
+            optimized.pop()
+        while len(optimized) > 3 and is_redundant_point(optimized[-1], optimized[0], optimized[1]):
+            optimized.pop(0)
+
+    # leave degenerate paths alone
+    return optimized if len(optimized) >= 2 else points
+
+
+def can_merge_paths(c1, c2):
+    # an open stroked path continuing exactly where the previous one ended renders the same as a single path, as
+    # every segment is stroked on its own. Only opaque, unfilled paths qualify so that nothing is blended twice.
+    return (isinstance(c1, PathCommand) and isinstance(c2, PathCommand) and c1.open and c2.open and
+            c1.type == c2.type and c1.stroke_color == c2.stroke_color and c1.stroke_width == c2.stroke_width and
+            c1.fill_color == 0 and c2.fill_color == 0 and (c1.stroke_color >> 6) == 3 and
+            c1.num_points + c2.num_points - 1 <= 0xFFFF and c1.points[-1] == c2.points[0])
+
+
+def optimize_commands(commands):
+    """
+    Returns an equivalent list of commands with duplicate and collinear points removed and adjacent compatible paths
+    merged. Commands are never reordered, as later commands are drawn on top of earlier ones.
+    """
+    optimized = []
+    for c in commands:
+        if isinstance(c, PathCommand):
+            c = copy.copy(c)
+            if optimized and can_merge_paths(optimized[-1], c):
+                c.points = optimized.pop().points + c.points[1:]
+            c.points = remove_redundant_points(c.points, c.open)
+        optimized.append(c)
+    return optimized
+
+
+def optimize_frames(frames):
+    return [optimize_commands(f) for f in frames]
+
+
+def commands_size(commands):
+    return COMMAND_LIST_HEADER.size + sum(c.serialized_size() for c in commands)
+
+
+def pack_commands_into(commands, buf, offset):
+    COMMAND_LIST_HEADER.pack_into(buf, offset, len(commands))   # number of commands in list
+    offset += COMMAND_LIST_HEADER.size
     for c in commands:
-        output += c.serialize()
+        offset = c.pack_into(buf, offset)
+    return offset
 
-    return output
+
+def serialize(commands):
+    buf = bytearray(commands_size(commands))
+    pack_commands_into(commands, buf, 0)
+    return bytes(buf)
 
 
 def print_commands(commands):
@@ -508,33 +1220,53 @@ def print_frames(frames):
         print_commands(frames[i])
 
 
+def frame_size(frame):
+    return FRAME_HEADER.size + commands_size(frame)
+
+
+def pack_frame_into(frame, duration, buf, offset):
+    FRAME_HEADER.pack_into(buf, offset, duration)   # Frame duration
+    return pack_commands_into(frame, buf, offset + FRAME_HEADER.size)
+
+
 def serialize_frame(frame, duration):
-    return pack('H', duration) + serialize(frame)   # Frame duration
+    buf = bytearray(frame_size(frame))
+    pack_frame_into(frame, duration, buf, 0)
+    return bytes(buf)
 
 
 def pack_header(size):
-    return pack('<BBhh', DRAW_COMMAND_VERSION, 0, int(round(size[0])), int(round(size[1])))
+    return IMAGE_HEADER.pack(DRAW_COMMAND_VERSION, 0, int(round(size[0])), int(round(size[1])))
 
 
-def serialize_sequence(frames, size, duration, play_count):
-    s = pack_header(size) + pack('H', play_count) + pack('H', len(frames))
-    for f in frames:
-        s += serialize_frame(f, duration)
+def _finish_output(buf, out_file):
+    # hand the preallocated buffer straight to the file object when given one, avoiding a copy
+    if out_file is not None:
+        out_file.write(buf)
+        return len(buf)
+    return bytes(buf)
 
-    output = "PDCS"
-    output += pack('I', len(s))
-    output += s
-    return output
 
+def serialize_sequence(frames, size, duration, play_count, out_file=None, durations=None):
+    # durations optionally gives every frame its own duration instead of the common one
+    # sequences are always written by a SequenceWriter, out_file has to be seekable for it to backpatch the headers
+    if durations is None:
+        durations = [duration] * len(frames)
+    buf = out_file if out_file is not None else io.BytesIO()
+    writer = SequenceWriter(buf, size, duration, play_count)
+    for f, frame_duration in zip(frames, durations):
+        writer.add_frame(f, frame_duration)
+    written = writer.close()
+    return written if out_file is not None else buf.getvalue()
 
-def serialize_image(commands, size):
-    s = pack_header(size)
-    s += serialize(commands)
 
-    output = "PDCI"
-    output += pack('I', len(s))
-    output += s
-    return output
+def serialize_image(commands, size, out_file=None):
+    data_size = IMAGE_HEADER.size + commands_size(commands)
+    buf = bytearray(FILE_HEADER.size + data_size)
+    FILE_HEADER.pack_into(buf, 0, "PDCI", data_size)
+    IMAGE_HEADER.pack_into(buf, FILE_HEADER.size, DRAW_COMMAND_VERSION, 0, int(round(size[0])), int(round(size[1])))
+    pack_commands_into(commands, buf, FILE_HEADER.size + IMAGE_HEADER.size)
+    return _finish_output(buf, out_file)
 
 
 def get_info(xml):
@@ -543,22 +1275,89 @@ def get_info(xml):
     return translate, viewbox[1]
 
 
-def parse_svg_image(filename, precise=False, raise_error=False):
-    root = get_xml(filename)
+def parse_svg_image(filename, precise=False, raise_error=False, tolerance=DEFAULT_FLATTEN_TOLERANCE,
+                    truncate_color=True):
+    root = read_xml(filename)
     translate, size = get_info(root)
-    cmd_list, error = get_commands(translate, root, precise, raise_error)
+    with stage_timer('traversal'):
+        cmd_list, error = get_commands(translate, root, precise, raise_error, truncate_color, tolerance=tolerance)
     return size, cmd_list, error
 
 
-def parse_svg_sequence(dir_name, precise=False, raise_error=False):
+def _parse_svg_frame(task):
+    filename, translate, precise, raise_error, tolerance, truncate_color, collect_stats = task
+    # frames may be parsed in another process, so each one collects its own stats which are merged afterwards
+    stats = ConversionStats(filename) if collect_stats else None
+    with active_stats(stats):
+        root = get_xml(filename)
+        with stage_timer('traversal'):
+            cmd_list, error = get_commands(translate, root, precise, raise_error, truncate_color, tolerance=tolerance)
+    return cmd_list, error, stats
+
+
+def _map_chunk(task):
+    func, chunk = task
+    return map(func, chunk)
+
+
+def _iter_pool_results(func, tasks, jobs):
+    # like pool.imap, but with a bounded number of chunks in flight so that results can't pile up
+    pool = multiprocessing.Pool(jobs)
+    try:
+        window = (jobs or multiprocessing.cpu_count()) * CHUNKS_AHEAD_PER_WORKER
+        pending = deque()
+        tasks = iter(tasks)
+        while True:
+            chunk = list(islice(tasks, FRAMES_PER_CHUNK))
+            if chunk:
+                pending.append(pool.apply_async(_map_chunk, ((func, chunk),)))
+            if pending and (len(pending) >= window or not chunk):
+                for result in pending.popleft().get():
+                    yield result
+            elif not chunk:
+                break
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_svg_frames(file_list, translate, precise=False, raise_error=False, jobs=None,
+                    tolerance=DEFAULT_FLATTEN_TOLERANCE, truncate_color=True):
+    """
+    Parses the frames of a sequence and yields (filename, commands, error) in the order of file_list, one frame at a
+    time. Worker processes parse a bounded number of frames ahead of the one being consumed (see FRAMES_PER_CHUNK),
+    so memory doesn't grow with the number of frames.
+    """
+    stats = get_active_stats()
+    # parse frames in a worker pool, unless already running inside a worker (daemonic processes can't have children)
+    parallel = not (jobs == 1 or len(file_list) <= 1 or multiprocessing.current_process().daemon)
+    # workers buffer their warnings, so that they are reported in frame order rather than as the workers get to them
+    tasks = ((filename, translate, precise, raise_error, tolerance, truncate_color, stats is not None or parallel)
+             for filename in file_list)
+    if parallel:
+        results = _iter_pool_results(_parse_svg_frame, tasks, jobs)
+    else:
+        results = (_parse_svg_frame(task) for task in tasks)
+    for filename, (cmd_list, error, frame_stats) in izip(file_list, results):
+        if frame_stats is not None:
+            warnings, frame_stats.warnings = frame_stats.warnings, []
+            if stats is not None:
+                stats.merge(frame_stats)
+            for w in warnings:
+                warn(w)
+        yield filename, cmd_list, error
+
+
+def parse_svg_sequence(dir_name, precise=False, raise_error=False, jobs=None, tolerance=DEFAULT_FLATTEN_TOLERANCE,
+                       truncate_color=True):
     frames = []
     error_files = []
     file_list = sorted(glob.glob(dir_name + "/*.svg"))
     if not file_list:
         return
     translate, size = get_info(get_xml(file_list[0]))  # get the viewbox from the first file
-    for filename in file_list:
-        cmd_list, error = get_commands(translate, get_xml(filename), precise, raise_error)
+    for filename, cmd_list, error in iter_svg_frames(file_list, translate, precise, raise_error, jobs, tolerance,
+                                                     truncate_color):
         if cmd_list is not None:
             frames.append(cmd_list)
         if error:
@@ -566,59 +1365,735 @@ def parse_svg_sequence(dir_name, precise=False, raise_error=False):
     return size, frames, error_files
 
 
-def create_pdc_from_path(path, sequence, out_path, verbose, duration, play_count, precise=False, raise_error=False):
+_converter_digest = None
+
+
+def get_library_stamp(name):
+    # where a library is installed and when it last changed, found without importing it (or pkg_resources, which
+    # alone takes longer than converting an icon) so that cache hits stay fast
+    path = None
+    try:
+        for part in name.split('.'):
+            path = imp.find_module(part, [path] if path else None)[1]
+    except ImportError:
+        return None
+    if os.path.isdir(path):
+        path = os.path.join(path, '__init__.py')
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_mtime, stat.st_size
+
+
+def get_converter_digest():
+    # the converter source is part of every cache key so that cached output is invalidated when the tools change, and
+    # so are the python version and the installs of the libraries that parse the paths and round the points
+    global _converter_digest
+    if _converter_digest is None:
+        h = hashlib.sha1()
+        tools_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in ('svg2pdc.py', 'pebble_image_routines.py'):
+            with open(os.path.join(tools_dir, name), 'rb') as f:
+                h.update(f.read())
+        h.update(repr((sys.version, get_library_stamp('svg.path'), get_library_stamp('numpy'))))
+        _converter_digest = h.digest()
+    return _converter_digest
+
+
+def get_cache_key(file_list, options):
+    # hash of the input bytes (every frame for sequences) plus all options that affect the output
+    h = hashlib.sha1(get_converter_digest())
+    h.update(repr(sorted(options.items())))
+    for filename in file_list:
+        h.update(os.path.basename(filename))
+        with open(filename, 'rb') as f:
+            h.update(hashlib.sha1(f.read()).digest())
+    return h.hexdigest()
+
+
+def read_cache(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, key + '.pdc'), 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def write_cache(cache_dir, key, output):
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    # write to a temporary file first so concurrent workers never see a partial entry
+    cache_path = os.path.join(cache_dir, key + '.pdc')
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(output)
+    os.rename(tmp_path, cache_path)
+
+
+def write_cache_file(cache_dir, key, path):
+    # same as write_cache, copying an output file that was streamed to disk instead of reading it into memory
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    cache_path = os.path.join(cache_dir, key + '.pdc')
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    shutil.copyfile(path, tmp_path)
+    os.rename(tmp_path, cache_path)
+
+
+def get_output_path(path, dir_name, sequence):
+    if sequence:
+        f = os.path.basename(dir_name.rstrip('/')) + '.pdc'
+    else:
+        base = os.path.basename(path)
+        f = '.'.join(base.split('.')[:-1]) + '.pdc'
+    return os.path.join(dir_name, f)
+
+
+def write_atomic(out_path, output):
+    # write next to the destination and rename, so readers (e.g. a running build) never see a partial file
+    tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+    with open(tmp_path, 'wb') as out_file:
+        out_file.write(output)
+    os.rename(tmp_path, out_path)
+
+
+def write_if_changed(out_path, output):
+    # leave up to date outputs untouched so that no-op rebuilds do not modify timestamps
+    try:
+        with open(out_path, 'rb') as f:
+            if f.read() == output:
+                return
+    except IOError:
+        pass
+    write_atomic(out_path, output)
+
+
+def report_optimization(before, after, verbose=False):
+    # the savings are counted in the stats, and only printed in verbose mode so they don't mix with other output
+    count('optimized_bytes', before - after)
+    if verbose:
+        print "Optimization saved {} bytes ({} -> {})".format(before - after, before, after)
+
+
+def report_merge(num_added, num_written, verbose=False):
+    count('merged_frames', num_added - num_written)
+    if verbose:
+        print "Merged {} held frames ({} -> {} frames)".format(num_added - num_written, num_added, num_written)
+
+
+def optimize_frames_and_report(frames, verbose=False):
+    optimized = optimize_frames(frames)
+    report_optimization(sum(commands_size(f) for f in frames), sum(commands_size(f) for f in optimized), verbose)
+    return optimized
+
+
+def frames_within_threshold(f1, f2, threshold):
+    # frames are near duplicates if they only differ by point coordinates (and circle radii) of at most threshold
+    if len(f1) != len(f2):
+        return False
+    for c1, c2 in zip(f1, f2):
+        if type(c1) is not type(c2) or c1.num_points != c2.num_points:
+            return False
+        if (c1.stroke_color, c1.stroke_width, c1.fill_color) != (c2.stroke_color, c2.stroke_width, c2.fill_color):
+            return False
+        if isinstance(c1, PathCommand) and (c1.type, c1.open) != (c2.type, c2.open):
+            return False
+        if isinstance(c1, CircleCommand) and abs(c1.radius - c2.radius) > threshold:
+            return False
+        if any(abs(v1 - v2) > threshold for v1, v2 in zip(c1.coords, c2.coords)):
+            return False
+    return True
+
+
+def command_bounds(command):
+    # bounds (x0, y0, x1, y1) in pixels of everything the command can draw, or None if it has no points
+    if not command.num_points:
+        return None
+    scale = 0.125 if getattr(command, 'type', None) == DRAW_COMMAND_TYPE_PRECISE_PATH else 1
+    margin = command.stroke_width / 2.0 + DIRTY_RECT_MARGIN
+    if isinstance(command, CircleCommand):
+        margin += command.radius
+    xs = command.coords[0::2]
+    ys = command.coords[1::2]
+    return min(xs) * scale - margin, min(ys) * scale - margin, max(xs) * scale + margin, max(ys) * scale + margin
+
+
+def union_bounds(b1, b2):
+    if b1 is None or b2 is None:
+        return b1 or b2
+    return min(b1[0], b2[0]), min(b1[1], b2[1]), max(b1[2], b2[2]), max(b1[3], b2[3])
+
+
+def bounds_to_rect(bounds, size):
+    # smallest (x, y, width, height) of whole pixels within the image containing the bounds
+    if bounds is None:
+        return 0, 0, 0, 0
+    x0 = min(max(int(math.floor(bounds[0])), 0), size[0])
+    y0 = min(max(int(math.floor(bounds[1])), 0), size[1])
+    x1 = min(max(int(math.ceil(bounds[2])) + 1, x0), size[0])
+    y1 = min(max(int(math.ceil(bounds[3])) + 1, y0), size[1])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class DirtyRectTracker(object):
+    """
+    Computes the region of the image that changes from one frame of a sequence to the next. Commands are compared in
+    drawing order, and the union of the bounds of the commands that differ (the old one, which has to be erased, and
+    the new one) is the dirty rectangle of the frame. The rectangle of the first frame is the change from the last
+    frame, for sequences that loop. Frames are added in the order they are written, so held frames merged by
+    HoldFrameMerger have a single rectangle.
+
+    Sidecar format (written next to the sequence as NAME.dirty):
+    | 4     | Magic word 'PDCD'
+    | 4     | Size of the data following these 8 bytes
+    | 2     | Number of frames
+    | n * 8 | Dirty rectangle of every frame: x, y, width, height (int16, a GRect), 0 x 0 if nothing changes
+    """
+
+    def __init__(self, size):
+        self.size = (int(round(size[0])), int(round(size[1])))
+        self.first = None
+        self.previous = None   # (commands, serialized commands) of the last frame
+        self.rects = []
+
+    def _changed_bounds(self, old, new):
+        bounds = None
+        for i in range(max(len(old[0]), len(new[0]))):
+            if i < len(old[0]) and i < len(new[0]) and old[1][i] == new[1][i]:
+                continue
+            if i < len(old[0]):
+                bounds = union_bounds(bounds, command_bounds(old[0][i]))
+            if i < len(new[0]):
+                bounds = union_bounds(bounds, command_bounds(new[0][i]))
+        return bounds
+
+    def add(self, frame):
+        frame = (frame, [c.serialize() for c in frame])
+        if self.previous is None:
+            self.first = frame
+            self.rects.append(None)  # known once the last frame has been added
+        else:
+            self.rects.append(bounds_to_rect(self._changed_bounds(self.previous, frame), self.size))
+        self.previous = frame
+
+    def get_rects(self):
+        rects = list(self.rects)
+        if rects:
+            rects[0] = bounds_to_rect(self._changed_bounds(self.previous, self.first), self.size)
+        return rects
+
+
+def serialize_dirty_rects(rects):
+    output = DIRTY_RECTS_HEADER.pack(len(rects)) + ''.join(DIRTY_RECT.pack(*r) for r in rects)
+    return FILE_HEADER.pack(DIRTY_RECTS_MAGIC, len(output)) + output
+
+
+def get_dirty_rects_path(path):
+    # resources/anim~bw.pdc -> resources/anim~bw.dirty
+    return os.path.splitext(path)[0] + '.dirty'
+
+
+class HoldFrameMerger(object):
+    """
+    Collapses runs of identical consecutive frames (or near duplicates, see frames_within_threshold) into the first
+    frame of the run, shown for the combined duration. Frames are added one at a time, add() and flush() return the
+    (frame, duration) pairs whose run has ended.
+    """
+
+    def __init__(self, duration, threshold=0):
+        self.duration = duration
+        self.threshold = threshold
+        self.held = None            # (frame, duration, serialized frame) of the current run
+        self.num_frames = 0
+
+    def add(self, frame, duration=None):
+        # duration overrides the common duration of the frames for this one
+        duration = self.duration if duration is None else duration
+        self.num_frames += 1
+        serialized = serialize(frame)
+        if self.held is not None:
+            held_frame, held_duration, held_serialized = self.held
+            if held_duration + duration <= 0xFFFF and (serialized == held_serialized or (
+                    self.threshold > 0 and frames_within_threshold(held_frame, frame, self.threshold))):
+                self.held = (held_frame, held_duration + duration, held_serialized)
+                return []
+        ended = self.flush()
+        self.held = (frame, duration, serialized)
+        return ended
+
+    def flush(self):
+        if self.held is None:
+            return []
+        held_frame, held_duration, _ = self.held
+        self.held = None
+        return [(held_frame, held_duration)]
+
+
+def merge_hold_frames(frames, duration, threshold=0):
+    # returns the remaining frames and their durations, see HoldFrameMerger
+    merger = HoldFrameMerger(duration, threshold)
+    merged = []
+    for f in frames:
+        merged += merger.add(f)
+    merged += merger.flush()
+    return [f for f, _ in merged], [d for _, d in merged]
+
+
+class SequenceWriter(object):
+    """
+    Writes a sequence to a seekable file one frame at a time. The headers are written first and the data size and
+    number of frames are backpatched by close(), so frames never have to be kept around. Frames are optionally
+    optimized and held frames merged on the way, as build_sequence does. With dirty_rects, the dirty rectangles of the
+    written frames are tracked as well, see DirtyRectTracker.
+    """
+
+    def __init__(self, out_file, size, duration, play_count, optimize=False, merge_threshold=None,
+                 dirty_rects=False, verbose=False):
+        self.out_file = out_file
+        self.size = size
+        self.duration = duration
+        self.play_count = play_count
+        self.optimize = optimize
+        self.merger = HoldFrameMerger(duration, merge_threshold) if merge_threshold is not None else None
+        self.dirty_rects = DirtyRectTracker(size) if dirty_rects else None
+        self.verbose = verbose
+        self.start = out_file.tell()
+        self.data_size = SEQUENCE_HEADER.size
+        self.num_frames = 0
+        self.optimized_sizes = [0, 0]   # serialized size of the commands before and after optimization
+        self._write_headers()
+
+    def _write_headers(self):
+        self.out_file.write(FILE_HEADER.pack("PDCS", self.data_size))
+        self.out_file.write(SEQUENCE_HEADER.pack(DRAW_COMMAND_VERSION, 0, int(round(self.size[0])),
+                                                 int(round(self.size[1])), self.play_count, self.num_frames))
+
+    def _write_frame(self, frame, duration):
+        if self.num_frames == 0xFFFF:
+            raise ValueError("A sequence can't have more than 65535 frames")
+        data = serialize_frame(frame, duration)
+        self.out_file.write(data)
+        if self.dirty_rects is not None:
+            self.dirty_rects.add(frame)
+        self.data_size += len(data)
+        self.num_frames += 1
+
+    def add_frame(self, frame, duration=None):
+        # duration overrides the common duration of the frames for this one
+        if self.optimize:
+            optimized = optimize_commands(frame)
+            self.optimized_sizes[0] += commands_size(frame)
+            self.optimized_sizes[1] += commands_size(optimized)
+            frame = optimized
+        if self.merger is not None:
+            frames = self.merger.add(frame, duration)
+        else:
+            frames = [(frame, self.duration if duration is None else duration)]
+        for f, duration in frames:
+            self._write_frame(f, duration)
+
+    def close(self):
+        # writes the frame still being held and backpatches the headers, returns the size of the sequence
+        if self.merger is not None:
+            for f, duration in self.merger.flush():
+                self._write_frame(f, duration)
+        end = self.out_file.tell()
+        self.out_file.seek(self.start)
+        self._write_headers()
+        self.out_file.seek(end)
+
+        if self.optimize:
+            report_optimization(self.optimized_sizes[0], self.optimized_sizes[1], self.verbose)
+        if self.merger is not None:
+            report_merge(self.merger.num_frames, self.num_frames, self.verbose)
+        return FILE_HEADER.size + self.data_size
+
+
+def build_sequence(frames, size, duration, play_count, optimize=False, merge_threshold=None, verbose=False):
+    # merge_threshold None keeps every frame, 0 merges identical frames only
+    out_file = io.BytesIO()
+    writer = SequenceWriter(out_file, size, duration, play_count, optimize, merge_threshold, verbose=verbose)
+    for f in frames:
+        writer.add_frame(f)
+    writer.close()
+    return out_file.getvalue()
+
+
+def stream_svg_sequence(file_list, out_path, duration, play_count, precise=False, raise_error=False, optimize=False,
+                        merge_threshold=None, tolerance=DEFAULT_FLATTEN_TOLERANCE, verbose=False, dirty_rects=False,
+                        jobs=None, variants=None):
+    """
+    Converts the svg frames of a sequence and streams them to out_path, or to one output per variant (see
+    get_variant_path). Each frame is written as soon as it is parsed and never kept, so memory use doesn't depend on
+    the number of frames. The outputs are written to temporary files first and renamed when complete.
+    Returns the files with errors and, by variant (None without variants), the path and size of every output and,
+    with dirty_rects, its serialized dirty rectangles.
+    """
+    translate, size = get_info(read_xml(file_list[0]))  # get the viewbox from the first file
+    targets = variants or [None]
+    truncate_color = None if variants else True
+    out_paths = dict((target, get_variant_path(out_path, target)) for target in targets)
+    files = {}
+    writers = {}
+    error_files = []
+    try:
+        for variant in targets:
+            files[variant] = open('{}.{}.tmp'.format(out_paths[variant], os.getpid()), 'w+b')
+            writers[variant] = SequenceWriter(files[variant], size, duration, play_count, optimize, merge_threshold,
+                                              dirty_rects, verbose)
+        num_frames = 0
+        for filename, cmd_list, error in iter_svg_frames(file_list, translate, precise, raise_error, jobs,
+                                                         tolerance, truncate_color):
+            if error:
+                error_files.append(filename)
+            if cmd_list is None:
+                continue
+            num_frames += 1
+            if verbose:
+                # with variants the commands are listed with the colors of the first one
+                print 'Frame {}:'.format(num_frames)
+                print_commands(resolve_commands(cmd_list, targets[0]))
+            with stage_timer('serialize'):
+                for variant in targets:
+                    writers[variant].add_frame(resolve_commands(cmd_list, variant))
+
+        sizes = {}
+        rects = {}
+        with stage_timer('write'):
+            for variant in targets:
+                writer = writers[variant]
+                sizes[variant] = writer.close()
+                files[variant].close()
+                os.rename(files[variant].name, out_paths[variant])
+                if dirty_rects:
+                    rects[variant] = serialize_dirty_rects(writer.dirty_rects.get_rects())
+                    write_atomic(get_dirty_rects_path(out_paths[variant]), rects[variant])
+        return error_files, out_paths, sizes, rects
+    finally:
+        for f in files.values():
+            if not f.closed:
+                f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+
+
+def create_pdc_from_path(path, sequence, out_path, verbose, duration, play_count, precise=False, raise_error=False,
+                         cache_dir=None, optimize=False, merge_threshold=None, tolerance=DEFAULT_FLATTEN_TOLERANCE,
+                         stats=None, variants=None, dirty_rects=False, jobs=None):
+    # stats optionally collects timings, counters and warnings (instead of printing them), see ConversionStats
+    # variants (see VARIANTS) parses the svg once and writes one output per variant, e.g. icon~bw.pdc and
+    # icon~color.pdc
+    # dirty_rects also writes the dirty rectangles of every frame of a sequence, see DirtyRectTracker
+    # jobs is the number of worker processes parsing the frames of a sequence (default: one per core)
+    with active_stats(stats if stats is not None else get_active_stats()):
+        return _create_pdc_from_path(path, sequence, out_path, verbose, duration, play_count, precise, raise_error,
+                                     cache_dir, optimize, merge_threshold, tolerance, variants, dirty_rects, jobs)
+
+
+def _create_pdc_from_path(path, sequence, out_path, verbose, duration, play_count, precise, raise_error, cache_dir,
+                          optimize, merge_threshold, tolerance, variants, dirty_rects, jobs):
     dir_name = path
-    output = ''
+    outputs = {}   # variant (None without variants) -> output
     error_files = []
+    targets = variants or [None]
+    warning_count = get_warning_count()
     if os.path.exists(path):
         if verbose:
             print path + ":"
         if os.path.isfile(path):
             dir_name = os.path.dirname(path)
-        frames = []
+
+        cache_keys = {}
+        # verbose runs list the commands, so they always convert (and still refresh the cache)
+        if cache_dir is not None:
+            file_list = sorted(glob.glob(dir_name + "/*.svg")) if sequence else [path]
+            if file_list and (sequence or os.path.isfile(path)):
+                options = {'precise': bool(precise), 'raise_error': bool(raise_error), 'truncate_color': True,
+                           'optimize': bool(optimize), 'tolerance': tolerance}
+                if sequence:
+                    options.update(duration=duration, play_count=play_count, merge_threshold=merge_threshold)
+                for target in targets:
+                    cache_keys[target] = get_cache_key(file_list, dict(options, variant=target) if target else options)
+                cached = dict((target, read_cache(cache_dir, key)) for target, key in cache_keys.items())
+                # the dirty rectangles only depend on the output, they are cached next to it
+                cached_rects = dict((target, read_cache(cache_dir, key + '-dirty') if sequence and dirty_rects else '')
+                                    for target, key in cache_keys.items())
+                if not verbose and all(output is not None for output in cached.values() + cached_rects.values()):
+                    if out_path is None:
+                        out_path = get_output_path(path, dir_name, sequence)
+                    for target, output in sorted(cached.items()):
+                        with stage_timer('write'):
+                            write_if_changed(get_variant_path(out_path, target), output)
+                            if cached_rects[target]:
+                                write_if_changed(get_dirty_rects_path(get_variant_path(out_path, target)),
+                                                 cached_rects[target])
+                        count('cache_hits')
+                        count('output_bytes', len(output))
+                    return error_files
+
+        # with variants the colors are resolved per variant after parsing
+        truncate_color = None if variants else True
         commands = []
         if sequence:
-            # get all .svg files in directory
-            result = parse_svg_sequence(dir_name, precise, raise_error)
-            if result:
-                frames = result[1]
-                size = result[0]
-                error_files += result[2]
-                output = serialize_sequence(frames, size, duration, play_count)
+            # get all .svg files in directory, the frames are streamed to the output files
+            file_list = sorted(glob.glob(dir_name + "/*.svg"))
+            if file_list:
+                if out_path is None:
+                    out_path = get_output_path(path, dir_name, sequence)
+                errors, out_paths, sizes, rects = stream_svg_sequence(file_list, out_path, duration, play_count,
+                                                                      precise, raise_error, optimize, merge_threshold,
+                                                                      tolerance, verbose, dirty_rects, jobs, variants)
+                error_files += errors
+                for target, output_size in sizes.items():
+                    count('output_bytes', output_size)
+                    if target in cache_keys and not error_files and get_warning_count() == warning_count:
+                        write_cache_file(cache_dir, cache_keys[target], out_paths[target])
+                        if target in rects:
+                            write_cache(cache_dir, cache_keys[target] + '-dirty', rects[target])
         elif os.path.isfile(path):
-            size, commands, error = parse_svg_image(path, precise, raise_error)
-            if commands:
-                output = serialize_image(commands, size)
+            size, commands, error = parse_svg_image(path, precise, raise_error, tolerance, truncate_color)
+            for target in targets:
+                target_commands = resolve_commands(commands, target) if commands else commands
+                if target_commands and optimize:
+                    target_commands = optimize_frames_and_report([target_commands], verbose)[0]
+                if target_commands:
+                    with stage_timer('serialize'):
+                        outputs[target] = serialize_image(target_commands, size)
             if error:
                 error_files += [path]
 
-        if verbose:
-            if sequence and frames:
-                print_frames(frames)
-            elif commands:
-                print_commands(commands)
+        # only cache clean conversions so that errors and warnings are reported again on the next run
+        if not error_files and get_warning_count() == warning_count:
+            for target, output in outputs.items():
+                if target in cache_keys:
+                    write_cache(cache_dir, cache_keys[target], output)
+
+        if verbose and commands:
+            # with variants the commands are listed with the colors of the first one
+            print_commands(resolve_commands(commands, targets[0]))
+    else:
+        warn("Invalid path")
+
+    if outputs and out_path is None:
+        out_path = get_output_path(path, dir_name, sequence)
+    for target, output in sorted(outputs.items()):
+        with stage_timer('write'):
+            write_atomic(get_variant_path(out_path, target), output)
+        count('output_bytes', len(output))
+
+    return error_files
+
+
+def expand_paths(paths):
+    # expand glob patterns (e.g. 'resources/*.svg') so that the shell is not required to do it
+    expanded = []
+    for p in paths:
+        matches = sorted(glob.glob(p))
+        expanded += matches if matches else [p]
+    return [os.path.abspath(p) for p in expanded]
+
+
+def _create_pdc_from_task(task):
+    args, kwargs, collect_stats = task
+    stats = ConversionStats(args[0]) if collect_stats else None
+    try:
+        error_files = create_pdc_from_path(*args, stats=stats, **kwargs)
+    except (ET.ParseError, IOError) as e:
+        # a broken file is reported with the others instead of ending the whole batch
+        with active_stats(stats):
+            warn("Could not convert {}: {}".format(args[0], e))
+        error_files = [args[0]]
+    return error_files, stats
+
+
+def create_pdcs_from_paths(paths, sequence, verbose, duration, play_count, precise=False, raise_error=False,
+                           jobs=None, stats_list=None, **kwargs):
+    # convert each path in its own worker process (one per core by default) and merge the error reports
+    # the ConversionStats of every path are appended to stats_list if it is given
+    # extra keyword arguments are passed on to create_pdc_from_path
+    parallel = not (jobs == 1 or len(paths) <= 1)
+    # workers buffer their warnings, so that they are printed in the order of the paths whatever the scheduling
+    tasks = [((path, sequence, None, verbose, duration, play_count, precise, raise_error), kwargs,
+              stats_list is not None or parallel) for path in paths]
+    if not parallel:
+        results = map(_create_pdc_from_task, tasks)
     else:
-        print "Invalid path"
-
-    if output != '':
-        if out_path is None:
-            if sequence:
-                f = os.path.basename(dir_name.rstrip('/')) + '.pdc'
-            else:
-                base = os.path.basename(path)
-                f = '.'.join(base.split('.')[:-1]) + '.pdc'
-            out_path = os.path.join(dir_name, f)
-        with open(out_path, 'w') as out_file:
-            out_file.write(output)
-            out_file.close()
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(_create_pdc_from_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
 
+    error_files = []
+    for result, stats in results:
+        error_files += result
+        if stats_list is not None:
+            stats_list.append(stats)
+        elif stats is not None:
+            for w in stats.warnings:
+                warn(w)
     return error_files
 
 
+class Watcher(object):
+    """
+    Keeps a warm process around and reconverts the watched images and sequences whenever their source files change.
+    Parsed frames are kept between polls, so only the modified frames of a sequence are parsed again.
+    """
+
+    def __init__(self, paths, sequence, out_path, verbose, duration, play_count, precise=False, optimize=False,
+                 merge_threshold=None, tolerance=DEFAULT_FLATTEN_TOLERANCE, variants=None, dirty_rects=False):
+        self.paths = paths
+        self.sequence = sequence
+        self.out_path = out_path
+        self.verbose = verbose
+        self.duration = duration
+        self.play_count = play_count
+        self.precise = precise
+        self.optimize = optimize
+        self.merge_threshold = merge_threshold
+        self.tolerance = tolerance
+        self.variants = variants
+        self.dirty_rects = dirty_rects
+        self.signatures = {}   # path -> modification times and sizes of its source files at the last conversion
+        self.frames = {}       # path -> {svg file -> ((modification time, size, translate), commands, error)}
+
+    def get_sources(self, path):
+        if self.sequence:
+            dir_name = path if os.path.isdir(path) else os.path.dirname(path)
+            return sorted(glob.glob(dir_name + "/*.svg"))
+        return [path] if os.path.isfile(path) else []
+
+    def get_signature(self, sources):
+        try:
+            return [(f, os.stat(f).st_mtime, os.stat(f).st_size) for f in sources]
+        except OSError:
+            return None  # a file disappeared while polling, check again next time
+
+    def convert_sequence(self, path, file_list):
+        dir_name = path if os.path.isdir(path) else os.path.dirname(path)
+        translate, size = get_info(read_xml(file_list[0]))  # get the viewbox from the first file
+        cached_frames = self.frames.get(path, {})
+        parsed_frames = {}
+        frames = []
+        error_files = []
+        for filename in file_list:
+            # same as the poll signature, the size catches edits within the modification time's resolution
+            stat = os.stat(filename)
+            key = (stat.st_mtime, stat.st_size, translate)
+            cached = cached_frames.get(filename)
+            if cached is None or cached[0] != key:
+                if self.verbose:
+                    print "Parsing " + filename
+                cmd_list, error = get_commands(translate, read_xml(filename), self.precise,
+                                               truncate_color=None if self.variants else True,
+                                               tolerance=self.tolerance)
+                cached = (key, cmd_list, error)
+            parsed_frames[filename] = cached
+            frames.append(cached[1])
+            if cached[2]:
+                error_files.append(filename)
+        self.frames[path] = parsed_frames
+
+        out_path = self.out_path if self.out_path is not None else get_output_path(path, dir_name, True)
+        for target in self.variants or [None]:
+            out_file = io.BytesIO()
+            writer = SequenceWriter(out_file, size, self.duration, self.play_count, self.optimize, self.merge_threshold,
+                                    self.dirty_rects, self.verbose)
+            for f in resolve_frames(frames, target):
+                writer.add_frame(f)
+            writer.close()
+            write_atomic(get_variant_path(out_path, target), out_file.getvalue())
+            if self.dirty_rects:
+                write_atomic(get_dirty_rects_path(get_variant_path(out_path, target)),
+                             serialize_dirty_rects(writer.dirty_rects.get_rects()))
+        return error_files
+
+    def poll(self):
+        for path in self.paths:
+            sources = self.get_sources(path)
+            signature = self.get_signature(sources)
+            if not sources or signature is None or signature == self.signatures.get(path):
+                continue
+            try:
+                if self.sequence:
+                    error_files = self.convert_sequence(path, sources)
+                else:
+                    error_files = create_pdc_from_path(path, False, self.out_path, self.verbose, self.duration,
+                                                       self.play_count, self.precise, optimize=self.optimize,
+                                                       tolerance=self.tolerance, variants=self.variants)
+            except (ET.ParseError, IOError, OSError) as e:
+                # most likely the file is still being saved, it's retried on the next poll
+                print "Could not convert {}: {}".format(path, e)
+                continue
+            self.signatures[path] = signature
+            print "Converted " + path
+            for ef in error_files:
+                print "\tErrors in " + str(ef)
+            sys.stdout.flush()
+
+    def run(self, interval):
+        print "Watching for changes, press Ctrl-C to stop"
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def write_stats_report(out_path, stats_list):
+    totals = ConversionStats()
+    for stats in stats_list:
+        totals.merge(stats)
+    report = {'files': [stats.as_dict() for stats in stats_list],
+              'totals': {'timings': totals.timings, 'counters': totals.counters, 'elements': totals.elements,
+                         'warnings': len(totals.warnings)}}
+    if out_path == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "{} warnings, see {}".format(len(totals.warnings), out_path)
+
+
 def main(args):
-    path = os.path.abspath(args.path)
-    error_files = create_pdc_from_path(path, args.sequence, args.output, args.verbose, args.duration, args.play_count,
-                                       args.precise)
+    paths = expand_paths(args.path)
+    merge_threshold = args.merge_threshold if args.merge_threshold is not None else 0 if args.merge_frames else None
+    if args.watch:
+        Watcher(paths, args.sequence, args.output, args.verbose, args.duration, args.play_count,
+                args.precise, args.optimize, merge_threshold, args.tolerance, args.variants,
+                args.dirty_rects).run(args.watch_interval)
+        return
+
+    cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else None
+    stats_list = [] if args.stats else None
+    if len(paths) == 1:
+        stats = ConversionStats(paths[0]) if args.stats else None
+        error_files = create_pdc_from_path(paths[0], args.sequence, args.output, args.verbose, args.duration,
+                                           args.play_count, args.precise, cache_dir=cache_dir,
+                                           optimize=args.optimize, merge_threshold=merge_threshold,
+                                           tolerance=args.tolerance, stats=stats, variants=args.variants,
+                                           dirty_rects=args.dirty_rects, jobs=args.jobs)
+        if stats is not None:
+            stats_list.append(stats)
+    else:
+        error_files = create_pdcs_from_paths(paths, args.sequence, args.verbose, args.duration, args.play_count,
+                                             args.precise, jobs=args.jobs, stats_list=stats_list, cache_dir=cache_dir,
+                                             optimize=args.optimize, merge_threshold=merge_threshold,
+                                             tolerance=args.tolerance, variants=args.variants,
+                                             dirty_rects=args.dirty_rects)
+    if stats_list is not None:
+        write_stats_report(args.stats, stats_list)
     if error_files:
         print "Errors in the following files:"
         for ef in error_files:
@@ -627,8 +2102,9 @@ def main(args):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('path', type=str,
-                        help="Path to svg file or directory (with multiple svg files)")
+    parser.add_argument('path', type=str, nargs='+',
+                        help="Path(s) to svg file or directory (with multiple svg files). Glob patterns such as "
+                             "'resources/*.svg' are expanded and converted in parallel")
     parser.add_argument('-s', '--sequence', action='store_true',
                         help="Path is a directory and a sequence will be produced as output")
     parser.add_argument('-o', '--output', type=str,
@@ -642,7 +2118,39 @@ if __name__ == '__main__':
                         help="Number of times the sequence should play - default = 1")
     parser.add_argument('-p', '--precise', action='store_true',
                         help="Use sub-pixel precision for paths")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="Number of worker processes used when converting multiple paths or the frames of a "
+                             "sequence - default = one per core")
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="Directory of a persistent conversion cache. Inputs whose contents and options are "
+                             "unchanged reuse the cached .pdc instead of being converted again")
+    parser.add_argument('-t', '--tolerance', type=float, default=DEFAULT_FLATTEN_TOLERANCE,
+                        help="Maximum distance between a curve and its flattened path, in pixels (1/8 pixels with "
+                             "--precise), before the points are snapped to valid coordinates. Must be positive - "
+                             "default = {}".format(DEFAULT_FLATTEN_TOLERANCE))
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help="Remove duplicate and collinear points and merge adjacent compatible paths")
+    parser.add_argument('-m', '--merge-frames', action='store_true',
+                        help="Collapse identical consecutive frames of a sequence into one longer frame")
+    parser.add_argument('--merge-threshold', type=int, default=None,
+                        help="Also collapse consecutive frames whose points differ by at most this many units "
+                             "(pixels, or 1/8 pixels with --precise). Implies --merge-frames")
+    parser.add_argument('--stats', '--profile', type=str, metavar='REPORT',
+                        help="Write a JSON report of the time spent in every stage, element and point counters and "
+                             "the warnings of every file to REPORT ('-' for stdout) instead of printing warnings")
+    parser.add_argument('--variants', type=str, nargs='+', choices=VARIANTS,
+                        help="Parse once and write one output per variant, tagged like NAME~bw.pdc (black and white, "
+                             "for aplite) and NAME~color.pdc (64 colors, for basalt and chalk)")
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help="Also write the region that changes in every frame of a sequence to NAME.dirty, for "
+                             "src/gdraw_command_dirty_rects.h")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="Keep running and reconvert the paths whenever their svg files change")
+    parser.add_argument('--watch-interval', type=float, default=0.25,
+                        help="Seconds between checks for changes in --watch mode - default = 0.25s")
     args = parser.parse_args()
+    if args.output is not None and len(expand_paths(args.path)) > 1:
+        parser.error("--output can only be used with a single path")
+    if args.tolerance <= 0:
+        parser.error("--tolerance must be positive")
     main(args)
-
-
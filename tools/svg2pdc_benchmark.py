@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Pebble Technology
+#
+'''
+Benchmarks the SVG to PDC pipeline. Every case is run over the resources/Pebble_50x50_*.svg icons or over generated
+synthetic SVGs (images scaled from 10 to 100k elements, sequences from 1 to 1000 frames) and times the stages of the
+conversion separately:
+get_xml - XML parsing
+get_commands - traversal and command creation (including coordinate conversion)
+convert_to_pebble_coordinates - coordinate conversion of the same point lists on its own
+serialize - serialize_image or serialize_sequence (skipped when a command list exceeds the 65535 commands the
+            format allows, as in the largest synthetic image)
+
+Each case runs in a fresh worker process so that its peak memory (max RSS) can be reported as well. Results are
+written as JSON; pass a previous result file with --compare to see the change of every timing.
+'''
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from StringIO import StringIO
+
+import svg2pdc
+
+RESOURCES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'resources')
+
+IMAGE_SCALES = [10, 100, 1000, 10000, 100000]
+SEQUENCE_SCALES = [1, 10, 100, 1000]
+SEQUENCE_FRAME_ELEMENTS = 20
+MAX_COMMANDS = 0xFFFF  # the number of commands in a list is serialized as 16 bits
+QUICK_IMAGE_SCALES = [10, 100, 1000]
+QUICK_SEQUENCE_SCALES = [1, 10, 100]
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+
+def generate_svg(num_elements, seed=0):
+    # valid (half pixel aligned) coordinates so that no invalid point warnings are printed
+    rnd = random.Random(seed)
+
+    def coord(limit):
+        return rnd.randint(0, limit * 2) / 2.0
+
+    def color():
+        return '#{:06X}'.format(rnd.randint(0, 0xFFFFFF))
+
+    elements = []
+    for i in range(num_elements):
+        kind = i % 6
+        if kind == 0:
+            points = ' '.join('{},{}'.format(coord(144), coord(168)) for _ in range(rnd.randint(3, 12)))
+            elements.append('<polygon fill="{}" stroke="{}" points="{}"/>'.format(color(), color(), points))
+        elif kind == 1:
+            points = ' '.join('{},{}'.format(coord(144), coord(168)) for _ in range(rnd.randint(2, 12)))
+            elements.append('<polyline fill="none" stroke="{}" stroke-width="2" points="{}"/>'.format(color(),
+                                                                                                   points))
+        elif kind == 2:
+            elements.append('<circle fill="{}" cx="{}" cy="{}" r="{}"/>'.format(color(), coord(144), coord(168),
+                                                                            rnd.randint(1, 20)))
+        elif kind == 3:
+            elements.append('<rect fill="{}" x="{}" y="{}" width="{}" height="{}"/>'.format(
+                color(), coord(100), coord(100), rnd.randint(1, 40), rnd.randint(1, 40)))
+        elif kind == 4:
+            elements.append('<line stroke="{}" stroke-width="3" x1="{}" y1="{}" x2="{}" y2="{}"/>'.format(
+                color(), coord(144), coord(168), coord(144), coord(168)))
+        else:
+            d = 'M{} {} '.format(coord(144), coord(168))
+            d += ' '.join('L{} {}'.format(coord(144), coord(168)) for _ in range(rnd.randint(2, 12)))
+            elements.append('<path fill="{}" stroke="#000000" d="{} Z"/>'.format(color(), d))
+
+    # group the elements like exported files do
+    groups = []
+    for i in range(0, len(elements), 50):
+        groups.append('<g opacity="0.9" stroke-width="1">' + ''.join(elements[i:i + 50]) + '</g>')
+    return ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 144 168">' + ''.join(groups) + '</svg>')
+
+
+def get_sources(case):
+    # returns a list of (name, file object factory) for every frame of a case
+    if case['source'] == 'resource':
+        return [(case['name'], lambda: open(case['path'], 'rb'))]
+    return [('frame{}'.format(i), lambda i=i: StringIO(generate_svg(case['elements'], seed=i)))
+            for i in range(case['frames'])]
+
+
+def time_call(timings, stage, func, *args):
+    start = time.time()
+    result = func(*args)
+    timings[stage] = timings.get(stage, 0.0) + time.time() - start
+    return result
+
+
+def run_case_once(case, sources, precise):
+    timings = {}
+    frames = []
+    num_points = 0
+    num_commands = 0
+    size = (0, 0)
+    for name, open_source in sources:
+        root = time_call(timings, 'get_xml', svg2pdc.get_xml, open_source())
+        translate, size = svg2pdc.get_info(root)
+        commands, error = time_call(timings, 'get_commands', svg2pdc.get_commands, translate, root, precise)
+        frames.append(commands)
+        num_commands += len(commands)
+
+        # convert the (valid) svg coordinates of the same point lists again on their own
+        point_lists = [[(x + 0.5, y + 0.5) for x, y in c.points] for c in commands]
+        num_points += sum(len(points) for points in point_lists)
+        start = time.time()
+        for points in point_lists:
+            svg2pdc.convert_points_to_pebble_coordinates(points, (0, 0), precise)
+        timings['convert_to_pebble_coordinates'] = timings.get('convert_to_pebble_coordinates', 0.0) + \
+            time.time() - start
+
+    counts = {'commands': num_commands, 'points': num_points, 'output_bytes': None}
+    if max(len(f) for f in frames) > MAX_COMMANDS:
+        return timings, counts  # too many commands for the format, only the parse stages can be measured
+
+    if case['sequence']:
+        output = time_call(timings, 'serialize', svg2pdc.serialize_sequence, frames, size, 33, 1)
+    else:
+        output = time_call(timings, 'serialize', svg2pdc.serialize_image, frames[0], size)
+    counts['output_bytes'] = len(output)
+    return timings, counts
+
+
+def run_case(task):
+    case, repeat, precise = task
+    sources = get_sources(case)
+    best = {}
+    counts = {}
+    stdout = sys.stdout
+    sys.stdout = NullWriter()  # the converter prints warnings, keep them out of the timings and the report
+    try:
+        for _ in range(repeat):
+            timings, counts = run_case_once(case, sources, precise)
+            for stage, value in timings.items():
+                best[stage] = min(best.get(stage, value), value)
+    finally:
+        sys.stdout = stdout
+
+    result = dict(case)
+    result.pop('path', None)
+    result.update(counts)
+    result['timings'] = best
+    result['total'] = sum(best.values())
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def get_cases(quick=False):
+    cases = []
+    for path in sorted(glob.glob(os.path.join(RESOURCES_DIR, 'Pebble_50x50_*.svg'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        cases.append({'name': 'resource/' + name, 'source': 'resource', 'path': path, 'sequence': False,
+                      'elements': None, 'frames': 1})
+    for n in (QUICK_IMAGE_SCALES if quick else IMAGE_SCALES):
+        cases.append({'name': 'image/{}'.format(n), 'source': 'synthetic', 'sequence': False, 'elements': n,
+                      'frames': 1})
+    for n in (QUICK_SEQUENCE_SCALES if quick else SEQUENCE_SCALES):
+        cases.append({'name': 'sequence/{}'.format(n), 'source': 'synthetic', 'sequence': True,
+                      'elements': SEQUENCE_FRAME_ELEMENTS, 'frames': n})
+    return cases
+
+
+def compare(results, baseline):
+    baseline_cases = dict((r['name'], r) for r in baseline['results'])
+    print '{:<40} {:<30} {:>10} {:>10} {:>8}'.format('case', 'stage', 'baseline', 'current', 'ratio')
+    for r in results['results']:
+        old = baseline_cases.get(r['name'])
+        if old is None:
+            continue
+        stages = sorted(r['timings'].items()) + [('total', r['total'])]
+        for stage, value in stages:
+            old_value = old['total'] if stage == 'total' else old['timings'].get(stage)
+            if not old_value:
+                continue
+            print '{:<40} {:<30} {:>10.4f} {:>10.4f} {:>8.2f}'.format(r['name'], stage, old_value, value,
+                                                                      value / old_value)
+
+
+def main(args):
+    cases = get_cases(args.quick)
+    if args.filter:
+        cases = [c for c in cases if args.filter in c['name']]
+
+    # one fresh process per case, so that peak memory is measured per case
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = []
+    try:
+        for case in cases:
+            result = pool.apply(run_case, ((case, args.repeat, args.precise),))
+            print '{:<40} {:>10.4f}s {:>10} KB'.format(result['name'], result['total'], result['peak_rss_kb'])
+            sys.stdout.flush()
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {'python': platform.python_version(), 'numpy': svg2pdc.get_numpy() is not None, 'precise': args.precise,
+              'repeat': args.repeat, 'timestamp': time.time(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, default='svg2pdc_benchmark.json',
+                        help="Path of the JSON result file - default = svg2pdc_benchmark.json")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Number of runs of every case, the fastest time of each stage is reported - default = 3")
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help="Only run the smaller synthetic cases")
+    parser.add_argument('-f', '--filter', type=str,
+                        help="Only run cases whose name contains this string")
+    parser.add_argument('-p', '--precise', action='store_true',
+                        help="Use sub-pixel precision for paths")
+    parser.add_argument('-c', '--compare', type=str,
+                        help="Previous JSON result file to compare the timings against")
+    args = parser.parse_args()
+    main(args)